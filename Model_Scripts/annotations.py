@@ -0,0 +1,172 @@
+"""
+@author: blair
+
+Description:
+    Columnar cache of the annotation CSVs. The annotation files have 100+
+    columns (morphometrics, colour stats, climate, DNA), but the loaders and
+    scripts only need a handful. Each CSV is parsed once into an uncompressed
+    .npz with one array per column, stored in a .cache folder next to it and
+    refreshed whenever the CSV's modification time or size changes. Reading
+    a column then only loads that column.
+
+    The label encoding (sorted class names, as LabelEncoder would produce)
+    is also computed once per training file and shared by every split.
+"""
+
+import os
+import io
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+
+def cache_path(path):
+    """
+        Returns the path of the columnar cache of an annotation CSV.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(path), '.cache', f'{stem}.npz')
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def save_npz_atomic(path, arrays):
+    """
+        Writes arrays as an uncompressed .npz at path. Written to a temporary
+        file first so readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(buffer.getvalue())
+    os.replace(path + '.tmp', path)
+
+
+def build_cache(path):
+    """
+        Parses an annotation CSV and writes its columnar cache.
+    """
+    meta = pd.read_csv(path)
+    arrays = {
+        '__columns__': np.array(meta.columns, dtype=str),
+        '__source__': _source_stamp(path),
+    }
+    for i, column in enumerate(meta.columns):
+        values = meta[column]
+        if values.dtype == object:
+            # Strings are stored as a fixed-width unicode array, plus a mask
+            # of the missing values
+            arrays[f'null_{i}'] = values.isna().to_numpy()
+            arrays[f'col_{i}'] = values.fillna('').to_numpy(dtype=str)
+        else:
+            arrays[f'col_{i}'] = values.to_numpy()
+
+    save_npz_atomic(cache_path(path), arrays)
+
+
+def _open_cache(path):
+    cached = cache_path(path)
+    if os.path.exists(cached):
+        store = np.load(cached)
+        if np.array_equal(store['__source__'], _source_stamp(path)):
+            return store
+        store.close()
+    build_cache(path)
+    return np.load(cached)
+
+
+def annotation_columns(path):
+    """
+        Returns the column names of an annotation CSV, in file order.
+    """
+    with _open_cache(path) as store:
+        return store['__columns__'].tolist()
+
+
+def read_annotations(path, columns=None):
+    """
+    Reads an annotation CSV through its columnar cache.
+
+    Parameters:
+    - path (str): Path to the annotation CSV
+    - columns (list): Column names or positions to read. All columns if None
+
+    Returns:
+    DataFrame: The requested columns, in the requested order
+    """
+    with _open_cache(path) as store:
+        names = store['__columns__'].tolist()
+        if columns is None:
+            columns = names
+        positions = [c if isinstance(c, int) else names.index(c) for c in columns]
+
+        data = {}
+        for i in positions:
+            values = store[f'col_{i}']
+            if f'null_{i}' in store.files:
+                values = values.astype(object)
+                values[store[f'null_{i}']] = np.nan
+            data[names[i]] = values
+
+    return pd.DataFrame(data)
+
+
+@lru_cache(maxsize=None)
+def label_encoding(train_path, class_labels, short_labels=None):
+    """
+    Class names of the training annotations, encoded once and shared by all
+    splits and scripts.
+
+    Parameters:
+    - train_path (str): Path to the training annotation CSV
+    - class_labels (str): Column of the long (hierarchical) class names
+    - short_labels (str): Column of the short written class names, optional
+
+    Returns:
+    tuple: (long class names sorted as LabelEncoder would, short class
+    names in the same order, or None)
+    """
+    columns = [class_labels] + ([short_labels] if short_labels else [])
+    train = read_annotations(train_path, columns)
+
+    classes = tuple(str(c) for c in sorted(train[class_labels].unique()))
+    if not short_labels:
+        return classes, None
+
+    first = train.drop_duplicates(class_labels).set_index(class_labels)[short_labels]
+    return classes, tuple(str(first[c]) for c in classes)
+
+
+def encode_labels(labels, classes):
+    """
+        Integer encodes labels against the sorted classes of label_encoding,
+        like LabelEncoder.transform.
+    """
+    labels = np.asarray(labels)
+    classes = np.asarray(classes)
+    index = np.searchsorted(classes, labels)
+    if np.any(index >= len(classes)) or np.any(classes[np.minimum(index, len(classes) - 1)] != labels):
+        raise ValueError('y contains previously unseen labels')
+    return index.astype(np.int32)
+
+
+def event_table(meta, data_cols):
+    """
+        The DNA columns are a property of the sampling Event, so every
+        specimen of an Event carries the same row. Returns the event names,
+        one (events x taxa) table row per event, and each specimen's row in
+        that table.
+    """
+    X = meta[data_cols].values.astype(np.float32)
+    events, event_index = np.unique(meta['Event'].values, return_inverse=True)
+
+    table = np.zeros((len(events), X.shape[1]), dtype=np.float32)
+    table[event_index] = X
+    if not np.array_equal(table[event_index], X):
+        raise ValueError('DNA columns differ between specimens of the same Event')
+
+    return events, table, event_index.astype(np.int32)
@@ -0,0 +1,51 @@
+"""
+@author: blair
+
+Description:
+    Measures input pipeline throughput (images/sec) of the graph-native
+    CTDataset pipeline against the old Python generator pipeline, and of the
+    graph pipeline with per-batch augmentation (batch_augment). No model is
+    run, so this is the rate at which the loader alone can feed training.
+"""
+
+import time
+import argparse
+import yaml
+from util_order import init_seed, init_device
+
+parser = argparse.ArgumentParser(description='Benchmark the data loaders.')
+parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_base.yaml')
+parser.add_argument('--loader', help="'base' (tf_loader) or 'fusion' (tf_loader_concat)", default='base')
+parser.add_argument('--split', help='Split to read', default='train')
+parser.add_argument('--batches', help='Batches to time (0 = one full epoch)', type=int, default=0)
+args = parser.parse_args()
+
+print(f'Using config "{args.config}"')
+cfg = yaml.safe_load(open(args.config, 'r'))
+cfg["seed"] = cfg["seed"][0]
+init_device(cfg)
+init_seed(cfg["seed"])
+
+if args.loader == 'fusion':
+    from tf_loader_concat import CTDataset
+else:
+    from tf_loader import CTDataset
+
+loader = CTDataset(cfg, split=args.split)
+
+for name, legacy, batch_augment in [('generator', True, False), ('graph', False, False), ('batched', False, True)]:
+    loader.batch_augment = batch_augment
+    data = loader.create_tf_dataset(legacy=legacy)
+    if args.batches:
+        data = data.take(args.batches + 1)
+
+    iterator = iter(data)
+    next(iterator)  # warm-up, not timed
+
+    images = 0
+    start = time.perf_counter()
+    for _, labels in iterator:
+        images += labels.shape[0]
+    elapsed = time.perf_counter() - start
+
+    print(f'{name:>9}: {images} images in {elapsed:.1f} s = {images / elapsed:.1f} images/sec')
@@ -0,0 +1,106 @@
+"""
+@author: blair
+
+Description:
+    Classification masks as one (events x classes) matrix. A mask file (e.g.
+    naive.csv or naive_sim.csv) has an 'event' column and one column per
+    class, in the encoded class order, that is > 0 where the DNA of the
+    sampling event detected the class. The naive mask keeps the detected
+    classes (1) and zeroes the rest; the weighted mask scales them by the DNA
+    precision of the class (dna_pr.json) and the rest by 1 - recall.
+
+    Every specimen is mapped to its event's row with one integer index, and a
+    mask is applied to the whole probability matrix as a single gather,
+    multiply and argmax, in chunks of rows so memory stays flat for any
+    number of specimens. Specimens whose event is not in the mask file are
+    left unmasked.
+
+    Example:
+        mask = MaskTable.read('naive_sim.csv')
+        rows = mask.rows(event_ids)
+        masked_probs, masked_preds = mask.weighted(dna_pr, Y_ordered).apply(probs, rows)
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class MaskTable:
+    """
+    Parameters:
+    - events (array): Sampling event of every mask row
+    - table (array): (events x classes) float32 mask, or a scipy.sparse
+      matrix of the same shape
+    """
+    def __init__(self, events, table):
+        self.events = np.asarray(events)
+        self.table = table
+        self.index = pd.Index(self.events)
+
+    @classmethod
+    def read(cls, path, sparse=False):
+        """
+            Reads a mask file into a naive mask. sparse=True keeps the table
+            as a scipy.sparse CSR matrix, for masks over thousands of classes.
+        """
+        mask = pd.read_csv(path)
+        events = mask.pop('event').to_numpy()
+        values = mask.to_numpy(dtype=np.float32)
+        table = np.where(values > 0, np.float32(1), values)
+        if sparse:
+            from scipy.sparse import csr_matrix
+            table = csr_matrix(table)
+        return cls(events, table)
+
+    @property
+    def num_classes(self):
+        return self.table.shape[1]
+
+    def weighted(self, dna_pr, classes):
+        """
+            The weighted mask: the DNA precision of each class where the
+            naive mask detected it, 1 - recall elsewhere.
+
+            Parameters:
+            - dna_pr (dict): {class name: {'precision': p, 'recall': r}}
+            - classes (list): Class names in encoded order (Y_ordered)
+        """
+        precision = np.array([dna_pr[name]['precision'] for name in classes], dtype=np.float32)
+        recall = np.array([dna_pr[name]['recall'] for name in classes], dtype=np.float32)
+        table = self.dense()
+        return MaskTable(self.events, np.where(table != 0, precision, 1 - recall).astype(np.float32))
+
+    def dense(self):
+        return self.table.toarray() if hasattr(self.table, 'toarray') else self.table
+
+    def rows(self, events):
+        """
+            Mask row of every specimen, from its sampling event. Events
+            missing from the mask get -1.
+        """
+        return self.index.get_indexer(np.asarray(events)).astype(np.int64)
+
+    def apply(self, probs, rows, chunk_size=65536):
+        """
+        Masks a probability matrix.
+
+        Parameters:
+        - probs (array): (specimens x classes) softmax probabilities
+        - rows (array): Mask row of every specimen, -1 for none (see rows())
+        - chunk_size (int): Specimens masked at a time
+
+        Returns:
+        tuple: (masked probabilities, masked predictions)
+        """
+        masked = np.empty(probs.shape, dtype=np.float32)
+        preds = np.empty(len(probs), dtype=np.int64)
+        for start in range(0, len(probs), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_rows = rows[chunk]
+            found = chunk_rows >= 0
+            weights = np.ones((len(chunk_rows), self.num_classes), dtype=np.float32)
+            gathered = self.table[chunk_rows[found]]
+            weights[found] = gathered.toarray() if hasattr(gathered, 'toarray') else gathered
+            np.multiply(probs[chunk], weights, out=masked[chunk])
+            preds[chunk] = masked[chunk].argmax(axis=1)
+        return masked, preds
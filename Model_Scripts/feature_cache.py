@@ -0,0 +1,145 @@
+"""
+@author: blair
+
+Description:
+    Cache of frozen backbone features. The ResNet50 backbone is frozen in both
+    models, so its pooled 2048-d output for an image never changes. Here we run
+    it once over every image (once per augmentation variant), store the
+    vectors as .npy files with a file name -> row index, and the training
+    scripts can then fit the heads straight from the cache.
+
+    Build the cache ahead of time with:
+        python feature_cache.py --config ../configs/exp_order_base.yaml
+"""
+
+import os
+import json
+import argparse
+import yaml
+import numpy as np
+from image_io import list_images
+
+VARIANTS = ('plain', 'flip')
+
+
+def feature_paths(cfg, interpolation):
+    """
+        Returns the index path and a dict of feature paths per variant.
+    """
+    feature_root = cfg.get('feature_root', os.path.join(cfg['data_root'], 'features'))
+    height, width = cfg['image_size']
+    stem = os.path.join(feature_root, f'resnet50_{height}x{width}_{interpolation}')
+    return f'{stem}_index.json', {variant: f'{stem}_{variant}.npy' for variant in VARIANTS}
+
+
+def build_features(cfg, interpolation, variants=VARIANTS, extractor=None):
+    """
+        Runs the frozen backbone over every image in the image folder and
+        writes one feature file per variant. Variants already on disk are
+        skipped.
+    """
+    # TensorFlow is only needed to build the cache, so the cache can be read
+    # without it (see head_trainer.py)
+    import tensorflow as tf
+    from tensorflow.keras.applications.resnet50 import preprocess_input
+    from image_io import decode_image
+    from models import build_feature_extractor
+
+    index_path, paths = feature_paths(cfg, interpolation)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+    img_file_names = list_images(cfg)
+    index = {name: row for row, name in enumerate(img_file_names)}
+
+    # A changed image folder invalidates every variant built against the old index
+    if os.path.exists(index_path):
+        with open(index_path) as json_file:
+            stale = json.load(json_file) != index
+        for path in paths.values():
+            if stale and os.path.exists(path):
+                os.remove(path)
+    with open(index_path, 'w') as json_file:
+        json.dump(index, json_file)
+
+    img_dir = os.path.join(cfg['data_root'], cfg['img_path'])
+    image_paths = [os.path.join(img_dir, name) for name in img_file_names]
+    img_size = cfg['image_size']
+
+    for variant in variants:
+        if os.path.exists(paths[variant]):
+            continue
+        if extractor is None:
+            extractor = build_feature_extractor()
+
+        data = tf.data.Dataset.from_tensor_slices(image_paths)
+        data = data.map(
+            lambda path: decode_image(path, img_size, interpolation),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE
+        )
+        data = data.batch(cfg['batch_size'])
+        if variant == 'flip':
+            data = data.map(lambda img: tf.reverse(img, axis=[2]))
+        data = data.map(
+            lambda img: preprocess_input(tf.cast(img, tf.float32)),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE
+        )
+        data = data.prefetch(tf.data.experimental.AUTOTUNE)
+
+        # Written to a temporary file first so a killed run never leaves a
+        # truncated cache behind
+        tmp_path = paths[variant] + '.tmp'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                        shape=(len(image_paths), extractor.output_shape[-1]))
+        row = 0
+        for img in data:
+            feats = extractor(img, training=False).numpy()
+            out[row:row + len(feats)] = feats
+            row += len(feats)
+            print(f'{variant}: {row}/{len(image_paths)}', end='\r')
+        print()
+        out.flush()
+        del out
+        os.replace(tmp_path, paths[variant])
+
+
+def load_features(cfg, interpolation, variants=VARIANTS):
+    """
+        Returns the file name -> row index and a dict of memory-mapped
+        feature arrays per variant, building whatever is missing.
+    """
+    index_path, paths = feature_paths(cfg, interpolation)
+    if not os.path.exists(index_path) or not all(os.path.exists(paths[v]) for v in variants):
+        build_features(cfg, interpolation, variants)
+
+    with open(index_path) as json_file:
+        index = json.load(json_file)
+
+    # Rebuild if images were added to or removed from the image folder
+    if sorted(index) != list_images(cfg):
+        build_features(cfg, interpolation, variants)
+        with open(index_path) as json_file:
+            index = json.load(json_file)
+
+    features = {v: np.load(paths[v], mmap_mode='r') for v in variants}
+    return index, features
+
+
+def split_features(img_file_names, index, features):
+    """
+        Gathers the cached features of one split, in the split's row order.
+    """
+    rows = np.array([index[name] for name in img_file_names])
+    return {variant: np.asarray(feats[rows]) for variant, feats in features.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the cached backbone features.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_base.yaml')
+    parser.add_argument('--interpolation', help="Resize method of the loader: 'nearest' (tf_loader) or 'bilinear' (tf_loader_concat)", default='nearest')
+    args = parser.parse_args()
+
+    print(f'Using config "{args.config}"')
+    cfg = yaml.safe_load(open(args.config, 'r'))
+    from util_order import init_device
+    init_device(cfg)
+    build_features(cfg, args.interpolation)
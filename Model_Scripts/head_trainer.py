@@ -0,0 +1,430 @@
+"""
+@author: blair
+
+Description:
+    Trains the baseline head or the fusion head on the cached backbone
+    features (see feature_cache.py) in vectorized NumPy, without TensorFlow.
+    The heads are the ones in models.py: Dense(hidden_size) -> BatchNorm ->
+    ReLU -> Dropout -> softmax, with the DNA branch of the same shape in
+    front of the fusion head, and weight_decay as L2 on the Dense kernels.
+    Training follows tf_train.py / tf_train_concat.py in --cached mode: Adam,
+    balanced class weights, a flipped or plain feature variant drawn per
+    sample and epoch, and min_epochs/patience early stopping on val_loss.
+    HeadTrainer can stop after any epoch and carry on later from state(),
+    which hparam_search.py uses to train its trials rung by rung.
+
+    The best heads are written as head-only checkpoints (see head_weights.py)
+    with weights in Keras get_weights() order, so models.load_checkpoint()
+    and the eval scripts load them like the ones written during Keras
+    training.
+
+    Example:
+        python head_trainer.py --config ../configs/exp_order_fusion.yaml --model fusion
+"""
+
+import os
+import json
+import argparse
+import yaml
+import numpy as np
+from annotations import read_annotations, annotation_columns, label_encoding, encode_labels, event_table
+from feature_cache import load_features, split_features
+from head_weights import checkpoint_meta, head_params, save_head_weights
+
+# Resize method of the loader each model's features were cached with, as
+# CTDataset.interpolation in tf_loader.py / tf_loader_concat.py
+INTERPOLATION = {'base': 'nearest', 'fusion': 'bilinear'}
+
+# Keras defaults of BatchNormalization and Adam
+BN_MOMENTUM = 0.99
+BN_EPSILON = 1e-3
+ADAM_BETAS = (0.9, 0.999)
+ADAM_EPSILON = 1e-7
+
+
+def load_split(cfg, split, fusion):
+    """
+        File names, encoded labels and (fusion only) DNA rows of one split,
+        read the way the loaders read them.
+    """
+    if fusion:
+        train_name, val_name = cfg['train_name'], cfg['val_name']
+    else:
+        train_name, val_name = 'train', 'valid'
+    anno_root = os.path.join(cfg['data_root'], cfg['annotate_root'])
+    anno_path = os.path.join(anno_root, f'{train_name}.csv' if split == 'train' else f'{val_name}.csv')
+    train_path = os.path.join(anno_root, f'{train_name}.csv')
+
+    columns = [cfg['file_name'], cfg['class_labels']]
+    if fusion:
+        data_cols = annotation_columns(anno_path)[cfg['data_cols'][0]:cfg['data_cols'][1]]
+        columns += ['Event'] + data_cols
+    meta = read_annotations(anno_path, columns)
+
+    classes, _ = label_encoding(train_path, cfg['class_labels'])
+    labels = encode_labels(meta[cfg['class_labels']], classes)
+
+    X = None
+    if fusion:
+        _, table, event_index = event_table(meta, data_cols)
+        X = table[event_index]
+    return meta[cfg['file_name']].tolist(), labels, X
+
+
+def balanced_class_weights(labels, num_classes):
+    """
+        n_samples / (n_present_classes * count), as
+        compute_class_weight("balanced"). Classes absent from training get 1.
+    """
+    counts = np.bincount(labels, minlength=num_classes)
+    present = counts > 0
+    weights = np.ones(num_classes, dtype=np.float32)
+    weights[present] = len(labels) / (present.sum() * counts[present])
+    return weights
+
+
+def glorot_uniform(rng, fan_in, fan_out):
+    limit = np.sqrt(6 / (fan_in + fan_out))
+    return rng.uniform(-limit, limit, (fan_in, fan_out)).astype(np.float32)
+
+
+class Block:
+    """
+        Dense -> BatchNormalization -> ReLU -> Dropout, with the Keras
+        weights [kernel, bias, gamma, beta, moving_mean, moving_variance].
+    """
+    def __init__(self, rng, fan_in, units, rate):
+        self.rate = rate
+        self.weights = [glorot_uniform(rng, fan_in, units), np.zeros(units, np.float32),
+                        np.ones(units, np.float32), np.zeros(units, np.float32),
+                        np.zeros(units, np.float32), np.ones(units, np.float32)]
+        # Moving mean and variance are updated by forward(), not by Adam
+        self.trainable = [True, True, True, True, False, False]
+
+    def forward(self, x, rng=None):
+        kernel, bias, gamma, beta, moving_mean, moving_var = self.weights
+        h = x @ kernel + bias
+        if rng is None:
+            # Inference: moving statistics, no dropout
+            xhat = (h - moving_mean) / np.sqrt(moving_var + BN_EPSILON)
+            return np.maximum(gamma * xhat + beta, 0)
+
+        mean, var = h.mean(axis=0), h.var(axis=0)
+        inv_std = 1 / np.sqrt(var + BN_EPSILON)
+        xhat = (h - mean) * inv_std
+        moving_mean *= BN_MOMENTUM
+        moving_mean += (1 - BN_MOMENTUM) * mean
+        moving_var *= BN_MOMENTUM
+        moving_var += (1 - BN_MOMENTUM) * var
+
+        out = gamma * xhat + beta
+        active = out > 0
+        keep = (rng.random(out.shape) >= self.rate) / (1 - self.rate)
+        self.cache = x, xhat, inv_std, active, keep
+        return np.where(active, out, 0) * keep
+
+    def backward(self, grad):
+        x, xhat, inv_std, active, keep = self.cache
+        kernel, _, gamma = self.weights[:3]
+        grad = grad * keep * active
+        d_gamma = (grad * xhat).sum(axis=0)
+        d_beta = grad.sum(axis=0)
+        d_xhat = grad * gamma
+        d_h = inv_std * (d_xhat - d_xhat.mean(axis=0) - xhat * (d_xhat * xhat).mean(axis=0))
+        grads = [x.T @ d_h, d_h.sum(axis=0), d_gamma, d_beta, None, None]
+        return d_h @ kernel.T, grads
+
+
+class Head:
+    """
+        The baseline head (fusion=False) or the fusion head, with weights in
+        the order of models.build_head / build_fusion_head get_weights().
+    """
+    def __init__(self, num_classes, feature_dim, ncol=None, seed=0, hidden_size=128, dropout=0.3):
+        rng = np.random.default_rng(seed)
+        self.hidden_size = hidden_size
+        self.dna = Block(rng, ncol, hidden_size, dropout) if ncol else None
+        self.block = Block(rng, feature_dim + (hidden_size if ncol else 0), hidden_size, dropout)
+        self.output = [glorot_uniform(rng, hidden_size, num_classes), np.zeros(num_classes, np.float32)]
+
+    def get_weights(self):
+        blocks = [self.dna, self.block] if self.dna else [self.block]
+        return [w for block in blocks for w in block.weights] + self.output
+
+    def set_weights(self, weights):
+        for w, value in zip(self.get_weights(), weights):
+            w[...] = value
+
+    def kernels(self):
+        """
+            Positions of the Dense kernels (the L2-regularized weights) in
+            get_weights().
+        """
+        num_blocks = 2 if self.dna else 1
+        return [6 * i for i in range(num_blocks)] + [6 * num_blocks]
+
+    def forward(self, feats, X=None, rng=None):
+        """
+            Softmax probabilities. rng switches on training mode (batch
+            statistics and dropout).
+        """
+        if self.dna:
+            feats = np.concatenate([self.dna.forward(X, rng), feats], axis=1)
+        self.hidden = self.block.forward(feats, rng)
+        logits = self.hidden @ self.output[0] + self.output[1]
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def backward(self, d_logits):
+        """
+            Gradients of every weight (None for the moving statistics), in
+            get_weights() order.
+        """
+        grads_out = [self.hidden.T @ d_logits, d_logits.sum(axis=0)]
+        d_concat, grads = self.block.backward(d_logits @ self.output[0].T)
+        if self.dna:
+            _, grads_dna = self.dna.backward(d_concat[:, :self.hidden_size])
+            grads = grads_dna + grads
+        return grads + grads_out
+
+
+class Adam:
+    """
+        Adam with the Keras update and defaults.
+    """
+    def __init__(self, weights, learning_rate):
+        self.learning_rate = learning_rate
+        self.m = [np.zeros_like(w) for w in weights]
+        self.v = [np.zeros_like(w) for w in weights]
+        self.t = 0
+
+    def apply(self, weights, grads):
+        self.t += 1
+        beta_1, beta_2 = ADAM_BETAS
+        lr = self.learning_rate * np.sqrt(1 - beta_2 ** self.t) / (1 - beta_1 ** self.t)
+        for w, g, m, v in zip(weights, grads, self.m, self.v):
+            if g is None:
+                continue
+            m *= beta_1
+            m += (1 - beta_1) * g
+            v *= beta_2
+            v += (1 - beta_2) * g * g
+            w -= lr * m / (np.sqrt(v) + ADAM_EPSILON)
+
+
+def cross_entropy(probs, labels):
+    return -np.log(np.clip(probs[np.arange(len(labels)), labels], 1e-7, 1))
+
+
+def l2_penalty(head, weight_decay):
+    """
+        The loss Keras l2(weight_decay) adds: weight_decay * sum(kernel**2)
+        over the Dense kernels.
+    """
+    weights = head.get_weights()
+    return weight_decay * sum(np.square(weights[i]).sum() for i in head.kernels())
+
+
+def evaluate(head, feats, labels, X=None, weight_decay=0.0, batch_size=1024):
+    """
+        Mean loss and accuracy in inference mode, like Keras validation. As
+        in Keras, the loss includes the L2 penalty of the kernels, so early
+        stopping and hparam_search.py see the same val_loss as model.fit.
+    """
+    losses, correct = 0.0, 0
+    for start in range(0, len(labels), batch_size):
+        end = start + batch_size
+        probs = head.forward(feats[start:end], None if X is None else X[start:end])
+        losses += cross_entropy(probs, labels[start:end]).sum()
+        correct += (probs.argmax(axis=1) == labels[start:end]).sum()
+    loss = losses / len(labels)
+    if weight_decay:
+        loss += l2_penalty(head, weight_decay)
+    return loss, correct / len(labels)
+
+
+class HeadTrainer:
+    """
+    Trains a head on cached features, epoch by epoch.
+
+    Parameters:
+    - cfg (dict): The experiment config, with seed set to one seed
+    - fusion (bool): Train the fusion head instead of the baseline head
+    - train (tuple): (features dict per variant, labels, DNA rows or None)
+    - valid (tuple): The same for the validation split
+    - log (callable): Where the per-epoch summary goes
+    - state (dict): A state() to carry on from, or None to start afresh
+    """
+    def __init__(self, cfg, fusion, train, valid, log=print, state=None):
+        self.cfg = cfg
+        self.train = train
+        self.valid = valid
+        self.log = log
+        train_feats, y_train, _ = train
+        params = head_params(cfg)
+        self.weight_decay = params['weight_decay']
+        self.class_weights = balanced_class_weights(y_train, cfg['num_classes'])
+        self.variants = [train_feats['plain']] + ([train_feats['flip']] if 'flip' in train_feats else [])
+
+        self.head = Head(cfg['num_classes'], train_feats['plain'].shape[1], cfg['num_col'] if fusion else None,
+                         seed=cfg['seed'], hidden_size=params['hidden_size'], dropout=params['dropout'])
+        self.weights = self.head.get_weights()
+        self.optimizer = Adam(self.weights, cfg['learning_rate'])
+
+        self.epoch = 0
+        self.history = {'loss': [], 'accuracy': [], 'val_loss': [], 'val_accuracy': []}
+        self.best = {'val_loss': (np.inf, None, 0), 'val_accuracy': (-np.inf, None, 0)}
+        self.wait = 0
+        self.stop_reason = None
+        if state is not None:
+            self.load_state(state)
+
+    def state(self):
+        """
+            Everything fit() needs to carry on: weights, Adam moments,
+            history, best weights and the early stopping counters.
+        """
+        return {
+            'weights': [w.copy() for w in self.weights],
+            'adam': ([m.copy() for m in self.optimizer.m], [v.copy() for v in self.optimizer.v], self.optimizer.t),
+            'epoch': self.epoch,
+            'history': {k: list(v) for k, v in self.history.items()},
+            'best': dict(self.best),
+            'wait': self.wait,
+            'stop_reason': self.stop_reason,
+        }
+
+    def load_state(self, state):
+        self.head.set_weights(state['weights'])
+        m, v, self.optimizer.t = state['adam']
+        for dst, src in zip(self.optimizer.m + self.optimizer.v, m + v):
+            dst[...] = src
+        self.epoch = state['epoch']
+        self.history = {k: list(v) for k, v in state['history'].items()}
+        self.best = dict(state['best'])
+        self.wait = state['wait']
+        self.stop_reason = state['stop_reason']
+
+    def run_epoch(self):
+        cfg = self.cfg
+        train_feats, y_train, X_train = self.train
+        valid_feats, y_valid, X_valid = self.valid
+        n = len(y_train)
+        batch_size = cfg['batch_size']
+        kernels = self.head.kernels()
+
+        # A new order and new flips per epoch, from (seed, epoch)
+        rng = np.random.default_rng([cfg['seed'], self.epoch])
+        order = rng.permutation(n)
+        flips = rng.random(n) < 0.5
+
+        loss_sum, correct = 0.0, 0
+        for start in range(0, n, batch_size):
+            rows = order[start:start + batch_size]
+            feats = np.where(flips[rows, None], self.variants[-1][rows], self.variants[0][rows])
+            labels = y_train[rows]
+
+            probs = self.head.forward(feats, None if X_train is None else X_train[rows], rng)
+            sample_weights = self.class_weights[labels]
+            # Keras averages the class-weighted losses over the batch size
+            loss_sum += (sample_weights * cross_entropy(probs, labels)).sum()
+            correct += (probs.argmax(axis=1) == labels).sum()
+
+            d_logits = probs.copy()
+            d_logits[np.arange(len(rows)), labels] -= 1
+            d_logits *= sample_weights[:, None] / len(rows)
+            grads = self.head.backward(d_logits)
+            if self.weight_decay:
+                # Keras l2(weight_decay) adds weight_decay * sum(kernel**2) to the loss
+                loss_sum += l2_penalty(self.head, self.weight_decay) * len(rows)
+                for i in kernels:
+                    grads[i] = grads[i] + 2 * self.weight_decay * self.weights[i]
+            self.optimizer.apply(self.weights, grads)
+
+        epoch = self.epoch
+        self.epoch += 1
+        val_loss, val_accuracy = evaluate(self.head, valid_feats['plain'], y_valid, X_valid, self.weight_decay)
+        for key, value in [('loss', loss_sum / n), ('accuracy', correct / n),
+                           ('val_loss', val_loss), ('val_accuracy', val_accuracy)]:
+            self.history[key].append(float(value))
+        self.log(f"Epoch {self.epoch}/{cfg['num_epochs']} - loss: {loss_sum / n:.4f} - accuracy: {correct / n:.4f} - "
+                 f"val_loss: {val_loss:.4f} - val_accuracy: {val_accuracy:.4f}")
+
+        if val_accuracy > self.best['val_accuracy'][0]:
+            self.best['val_accuracy'] = (val_accuracy, [w.copy() for w in self.weights], epoch)
+        if val_loss < self.best['val_loss'][0]:
+            self.best['val_loss'] = (val_loss, [w.copy() for w in self.weights], epoch)
+            self.wait = 0
+        elif epoch >= cfg.get('min_epochs', 0):
+            self.wait += 1
+            if self.wait >= cfg.get('patience', cfg['num_epochs']):
+                self.stop_reason = 'patience'
+
+    def fit(self, epochs):
+        """
+            Trains until epoch number epochs, or until early stopping.
+        """
+        epochs = min(epochs, self.cfg['num_epochs'])
+        while self.epoch < epochs and self.stop_reason is None:
+            self.run_epoch()
+        if self.stop_reason is None and self.epoch >= self.cfg['num_epochs']:
+            self.stop_reason = 'num_epochs'
+        return self
+
+    @property
+    def done(self):
+        return self.stop_reason is not None
+
+    def result(self):
+        """
+        Returns:
+        tuple: (history dict, best val_loss weights, best val_accuracy weights,
+        best val_loss epoch)
+        """
+        history = dict(self.history, stop_reason=self.stop_reason or 'num_epochs')
+        history['stopped_epoch'] = self.epoch if self.stop_reason == 'patience' else None
+        return history, self.best['val_loss'][1], self.best['val_accuracy'][1], self.best['val_loss'][2] + 1
+
+
+def train_head(cfg, fusion, train, valid, log=print):
+    """
+    Trains a head on cached features for num_epochs, or until early stopping.
+    Parameters as HeadTrainer.
+
+    Returns:
+    tuple: (history dict, best val_loss weights, best val_accuracy weights,
+    best val_loss epoch)
+    """
+    return HeadTrainer(cfg, fusion, train, valid, log).fit(cfg['num_epochs']).result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train a head on cached features with NumPy.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_fusion.yaml')
+    parser.add_argument('--model', help="'base' (tf_train.py head) or 'fusion' (tf_train_concat.py head)", default='fusion')
+    parser.add_argument('--seed', help='Seed index', type=int, default=0)
+    parser.add_argument('--output', help='Folder for the checkpoints and history', default='.')
+    args = parser.parse_args()
+
+    print(f'Using config "{args.config}"')
+    cfg = yaml.safe_load(open(args.config, 'r'))
+    cfg['seed'] = cfg['seed'][args.seed]
+    experiment = cfg['experiment_name']
+    fusion = args.model == 'fusion'
+
+    index, features = load_features(cfg, INTERPOLATION[args.model])
+    splits = {}
+    for split in ['train', 'valid']:
+        names, labels, X = load_split(cfg, split, fusion)
+        splits[split] = (split_features(names, index, features), labels, X)
+
+    history, best_loss, best_acc, best_epoch = train_head(cfg, fusion, splits['train'], splits['valid'])
+
+    # Same files as the Keras training scripts in head checkpoint mode
+    os.makedirs(args.output, exist_ok=True)
+    meta = dict(checkpoint_meta(cfg, fusion), trainer='numpy')
+    save_head_weights(os.path.join(args.output, f'{experiment}_loss.npz'), best_loss, dict(meta, monitor='val_loss'))
+    save_head_weights(os.path.join(args.output, f'{experiment}_acc.npz'), best_acc, dict(meta, monitor='val_accuracy'))
+    with open(os.path.join(args.output, f'{experiment}_{best_epoch}.json'), 'w') as json_file:
+        json.dump(history, json_file)
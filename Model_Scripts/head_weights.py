@@ -0,0 +1,63 @@
+"""
+@author: blair
+
+Description:
+    File format of the head-only checkpoints. Only the trainable head (or
+    fusion head) is stored, as an .npz of its weights in Keras get_weights()
+    order, with a JSON record of the frozen backbone and head to rebuild them
+    into. Written by util_order.HeadCheckpoint and head_trainer.py, and read
+    by models.load_checkpoint. NumPy only, so it can be used without
+    TensorFlow.
+"""
+
+import json
+import numpy as np
+from annotations import save_npz_atomic
+
+
+def head_params(cfg):
+    """
+        Size and regularization of the heads: hidden_size units per Dense
+        layer, dropout rate, and weight_decay as L2 on the Dense kernels.
+    """
+    return {
+        'hidden_size': cfg.get('hidden_size', 128),
+        'dropout': cfg.get('dropout', 0.3),
+        'weight_decay': cfg.get('weight_decay', 0.0),
+    }
+
+
+def checkpoint_meta(cfg, fusion):
+    """
+        What a head-only checkpoint needs to rebuild the full model: the
+        backbone it was trained on, and the head.
+    """
+    return {
+        'backbone': 'resnet50',
+        'backbone_weights': 'imagenet',
+        'model': 'fusion' if fusion else 'base',
+        'num_classes': cfg['num_classes'],
+        'num_col': cfg['num_col'] if fusion else None,
+        'experiment': cfg['experiment_name'],
+        **head_params(cfg),
+    }
+
+
+def save_head_weights(path, weights, meta):
+    """
+        Writes the head's weights and meta to path. Written to a temporary
+        file first so a killed run never leaves a truncated checkpoint behind.
+    """
+    arrays = {f'w{i}': w for i, w in enumerate(weights)}
+    save_npz_atomic(path, dict(arrays, meta=np.array(json.dumps(dict(meta, num_weights=len(weights))))))
+
+
+def load_head_weights(path):
+    """
+        Returns the weights (for head.set_weights) and meta of a head-only
+        checkpoint.
+    """
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        weights = [data[f'w{i}'] for i in range(meta['num_weights'])]
+    return weights, meta
@@ -0,0 +1,205 @@
+"""
+@author: blair
+
+Description:
+    Searches the head hyperparameters (learning_rate, weight_decay,
+    hidden_size and dropout) on the cached backbone features, with the NumPy
+    trainer of head_trainer.py. Trials are sampled from the search space and
+    trained in parallel worker processes, each of which loads the feature
+    cache once. Successive halving prunes them on val_loss: every trial is
+    trained to the first rung, the best 1/eta of them carry on to the next
+    rung (eta times as many epochs) from where they stopped, and so on up to
+    num_epochs.
+
+    The search space defaults to SPACE and can be narrowed or widened with a
+    'search' block in the config, e.g.
+        search:
+          learning_rate: [0.00001, 0.01, log]
+          hidden_size: [64, 128, 256]
+
+    Writes every trial to {experiment}_search.csv, best first, and the best
+    trial as a config in the format of configs/, ready for tf_train.py,
+    tf_train_concat.py or head_trainer.py.
+
+    Example:
+        python hparam_search.py --config ../configs/exp_order_fusion.yaml --model fusion --trials 27
+"""
+
+import os
+import sys
+import math
+import time
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import yaml
+from feature_cache import load_features, split_features
+from head_trainer import INTERPOLATION, HeadTrainer, load_split
+from launch_seeds import SCRIPT_DIR, pool_size
+
+# [low, high, 'log' or 'linear'] for a range, or a list of choices
+SPACE = {
+    'learning_rate': [1e-5, 1e-2, 'log'],
+    'weight_decay': [1e-6, 1e-2, 'log'],
+    'hidden_size': [64, 128, 256, 512],
+    'dropout': [0.0, 0.5, 'linear'],
+}
+
+# Set in every worker process by init_worker
+_cfg = None
+_fusion = None
+_splits = None
+
+
+def sample(space, rng):
+    """
+        One configuration drawn from the search space.
+    """
+    params = {}
+    for name, values in space.items():
+        if len(values) == 3 and values[2] in ('log', 'linear'):
+            low, high, scale = values
+            if scale == 'log':
+                params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            else:
+                params[name] = float(rng.uniform(low, high))
+        else:
+            params[name] = values[rng.integers(len(values))]
+    return params
+
+
+def rungs(min_epochs, max_epochs, eta):
+    """
+        Epochs at the end of each rung: min_epochs, eta * min_epochs, ...,
+        up to max_epochs.
+    """
+    epochs = [min_epochs]
+    while epochs[-1] * eta < max_epochs:
+        epochs.append(epochs[-1] * eta)
+    if epochs[-1] < max_epochs:
+        epochs.append(max_epochs)
+    return epochs
+
+
+def init_worker(cfg, fusion):
+    """
+        Reads the feature cache and annotations once per worker process.
+    """
+    global _cfg, _fusion, _splits
+    _cfg, _fusion = cfg, fusion
+    index, features = load_features(cfg, INTERPOLATION['fusion' if fusion else 'base'])
+    _splits = {}
+    for split in ['train', 'valid']:
+        names, labels, X = load_split(cfg, split, fusion)
+        _splits[split] = (split_features(names, index, features), labels, X)
+
+
+def run_trial(trial_id, params, epochs, state):
+    """
+        Trains one trial up to epochs, carrying on from state (None for a new
+        trial). Returns the trial's new state.
+    """
+    cfg = dict(_cfg, **params)
+    trainer = HeadTrainer(cfg, _fusion, _splits['train'], _splits['valid'], log=lambda line: None, state=state)
+    start = time.time()
+    trainer.fit(epochs)
+    print(f"trial {trial_id}: {trainer.epoch} epochs, best val_loss {trainer.best['val_loss'][0]:.4f} "
+          f"({time.time() - start:.0f}s)", flush=True)
+    return trainer.state()
+
+
+def summary(trial_id, params, state, rung):
+    """
+        One leaderboard row. A trial is pruned if successive halving dropped
+        it before it reached num_epochs or early stopping.
+    """
+    best_loss, _, best_epoch = state['best']['val_loss']
+    best_acc = state['best']['val_accuracy'][0]
+    return dict(trial=trial_id, **params, rung=rung, epochs=state['epoch'],
+                val_loss=float(best_loss), val_accuracy=float(best_acc), best_epoch=best_epoch + 1,
+                pruned=state['stop_reason'] is None, stop_reason=state['stop_reason'])
+
+
+def tuned_config(path, params):
+    """
+        The config at path with the best hyperparameters filled in.
+    """
+    cfg = yaml.safe_load(open(path, 'r'))
+    cfg['experiment_name'] = f"{cfg['experiment_name']}_tuned"
+    cfg.update(params)
+    cfg.pop('search', None)
+    return cfg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the head hyperparameters on cached features.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_fusion.yaml')
+    parser.add_argument('--model', help="'base' (tf_train.py head) or 'fusion' (tf_train_concat.py head)", default='fusion')
+    parser.add_argument('--seed', help='Seed index, for both the trials and the sampling', type=int, default=0)
+    parser.add_argument('--trials', help='Number of sampled configurations', type=int, default=27)
+    parser.add_argument('--eta', help='Keep the best 1/eta of the trials at every rung', type=int, default=3)
+    parser.add_argument('--min-epochs', help='Epochs of the first rung', type=int, default=4)
+    parser.add_argument('--workers', help='Concurrent trials (0 = as many as the cores and memory allow)', type=int, default=0)
+    parser.add_argument('--threads', help='CPU threads per trial (0 = the cores split between the trials)', type=int, default=0)
+    parser.add_argument('--memory', help='Host memory (GB) one worker needs', type=float, default=4)
+    parser.add_argument('--output', help='Folder for the leaderboard and the tuned config', default='.')
+    args = parser.parse_args()
+
+    print(f'Using config "{args.config}"')
+    cfg = yaml.safe_load(open(args.config, 'r'))
+    cfg['seed'] = cfg['seed'][args.seed]
+    experiment = cfg['experiment_name']
+    fusion = args.model == 'fusion'
+    space = dict(SPACE, **cfg.get('search', {}))
+
+    rng = np.random.default_rng(cfg['seed'])
+    trials = {i: sample(space, rng) for i in range(args.trials)}
+    states = {i: None for i in trials}
+    rows = {}
+    schedule = rungs(args.min_epochs, cfg['num_epochs'], args.eta)
+    workers, threads = pool_size(args.trials, args.workers, args.threads, args.memory)
+    print(f'{args.trials} trials, rungs at epochs {schedule}, {workers} worker(s) with {threads} thread(s) each')
+
+    # Build the feature cache once, before the workers start reading it
+    subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, 'launch_seeds.py'), '--config', args.config,
+                    '--model', args.model, '--prepare', '--cached'], check=True)
+
+    # Fresh worker processes, so NumPy picks up the thread count as it loads
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(threads)
+    context = multiprocessing.get_context('spawn')
+
+    alive = list(trials)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(cfg, fusion)) as pool:
+        for rung, epochs in enumerate(schedule):
+            futures = {i: pool.submit(run_trial, i, trials[i], epochs, states[i]) for i in alive}
+            for i, future in futures.items():
+                states[i] = future.result()
+                rows[i] = summary(i, trials[i], states[i], rung)
+
+            # Trials stopped early by patience are finished and keep their
+            # place on the leaderboard, but not in the next rung
+            alive.sort(key=lambda i: rows[i]['val_loss'])
+            keep = max(1, math.ceil(len(alive) / args.eta))
+            alive = [i for i in alive[:keep] if states[i]['stop_reason'] is None]
+            best_loss = min(rows[i]['val_loss'] for i in futures)
+            print(f'rung {rung} ({epochs} epochs): best val_loss {best_loss:.4f}, {len(alive)} trial(s) carry on')
+            if not alive:
+                break
+
+    os.makedirs(args.output, exist_ok=True)
+    # Finished trials first, as a pruned trial's val_loss is from fewer epochs
+    leaderboard = pd.DataFrame(rows.values()).sort_values(['pruned', 'val_loss'])
+    leaderboard.to_csv(os.path.join(args.output, f'{experiment}_search.csv'), index=False)
+    print(leaderboard.head(10).to_string(index=False))
+
+    best = int(leaderboard.iloc[0]['trial'])
+    tuned = tuned_config(args.config, trials[best])
+    tuned_path = os.path.join(args.output, f"{tuned['experiment_name']}.yaml")
+    with open(tuned_path, 'w') as yaml_file:
+        yaml.safe_dump(tuned, yaml_file, sort_keys=False)
+    print(f'Best trial {best}: {trials[best]}, written to {tuned_path}')
@@ -0,0 +1,55 @@
+"""
+@author: blair
+
+Description:
+    Image listing and decoding helpers shared by the data loaders and the
+    cached feature builder. TensorFlow is only imported by the decoders, so
+    list_images() also works where it is not installed (see head_trainer.py).
+"""
+
+import os
+
+# ImageNet channel means subtracted by ResNet50 preprocess_input, BGR order
+IMAGENET_BGR_MEAN = [103.939, 116.779, 123.68]
+
+
+def list_images(cfg):
+    """
+        Returns the sorted file names of every image in the image folder.
+    """
+    img_dir = os.path.join(cfg['data_root'], cfg['img_path'])
+    return sorted(f for f in os.listdir(img_dir) if f.lower().endswith('.jpg'))
+
+
+def decode_image(image_path, img_size, interpolation='bilinear'):
+    """
+        Reads, decodes and resizes one image inside the TensorFlow graph.
+        Returns a uint8 tensor; images stay uint8 until preprocess_input so
+        shuffle and prefetch buffers hold a quarter of the bytes.
+    """
+    import tensorflow as tf
+    return decode_bytes(tf.io.read_file(image_path), img_size, interpolation)
+
+
+def decode_bytes(encoded, img_size, interpolation='bilinear'):
+    """
+        Decodes and resizes one encoded image (e.g. cut out of a shard, see
+        shard_pack.py) to a uint8 tensor, like decode_image.
+    """
+    import tensorflow as tf
+    img = tf.io.decode_image(encoded, channels=3, expand_animations=False)
+    img = tf.image.resize(img, img_size, method=interpolation)
+    if img.dtype != tf.uint8:
+        img = tf.saturate_cast(tf.round(img), tf.uint8)
+    return img
+
+
+def preprocess_uint8(images):
+    """
+        ResNet50 preprocess_input (RGB -> BGR, minus the ImageNet channel
+        means) of uint8 images, with the same float32 values. The channels
+        are swapped while the images are still uint8, which is several times
+        faster than preprocess_input on the float images.
+    """
+    import tensorflow as tf
+    return tf.cast(tf.reverse(images, axis=[-1]), tf.float32) - tf.constant(IMAGENET_BGR_MEAN)
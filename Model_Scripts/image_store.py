@@ -0,0 +1,129 @@
+"""
+@author: blair
+
+Description:
+    Memory-mapped store of pre-resized images. Every image in the image folder
+    is decoded and resized once, and written as uint8 into one contiguous
+    N x height x width x 3 .npy array, next to a file name -> row index. The
+    loaders then read whole batches from the memory map (see
+    ImageStore.batch) instead of decoding JPEGs every epoch, and concurrent
+    training processes share the pages through the OS page cache.
+
+    Build the store ahead of time with:
+        python image_store.py --config ../configs/exp_order_base.yaml
+"""
+
+import os
+import json
+import argparse
+import yaml
+import numpy as np
+import tensorflow as tf
+from image_io import list_images, decode_image
+from util_order import init_device
+
+
+def store_paths(cfg, interpolation):
+    """
+        Returns the paths of the image array and its index.
+    """
+    store_root = cfg.get('store_root', os.path.join(cfg['data_root'], 'image_store'))
+    height, width = cfg['image_size']
+    stem = os.path.join(store_root, f'images_{height}x{width}_{interpolation}')
+    return f'{stem}.npy', f'{stem}_index.json'
+
+
+def build_image_store(cfg, interpolation):
+    """
+        Decodes and resizes every image in the image folder and writes them
+        to the memory-mapped store.
+    """
+    array_path, index_path = store_paths(cfg, interpolation)
+    os.makedirs(os.path.dirname(array_path), exist_ok=True)
+
+    img_file_names = list_images(cfg)
+    img_dir = os.path.join(cfg['data_root'], cfg['img_path'])
+    image_paths = [os.path.join(img_dir, name) for name in img_file_names]
+    img_size = cfg['image_size']
+
+    data = tf.data.Dataset.from_tensor_slices(image_paths)
+    data = data.map(
+        lambda path: decode_image(path, img_size, interpolation),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+    data = data.batch(256).prefetch(tf.data.experimental.AUTOTUNE)
+
+    # Written to a temporary file first so a killed run never leaves a
+    # truncated store behind
+    tmp_path = array_path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                    shape=(len(image_paths), *img_size, 3))
+    row = 0
+    for img in data:
+        out[row:row + len(img)] = img.numpy()
+        row += len(img)
+        print(f'{row}/{len(image_paths)}', end='\r')
+    print()
+    out.flush()
+    del out
+    os.replace(tmp_path, array_path)
+
+    with open(index_path, 'w') as json_file:
+        json.dump({name: row for row, name in enumerate(img_file_names)}, json_file)
+
+
+class ImageStore:
+
+    def __init__(self, cfg, interpolation):
+        """
+            Opens the store read-only, building it first if it is missing.
+        """
+        array_path, index_path = store_paths(cfg, interpolation)
+        if not os.path.exists(array_path) or not os.path.exists(index_path):
+            build_image_store(cfg, interpolation)
+
+        with open(index_path) as json_file:
+            self.index = json.load(json_file)
+
+        # Rebuild if images were added to or removed from the image folder
+        if sorted(self.index) != list_images(cfg):
+            build_image_store(cfg, interpolation)
+            with open(index_path) as json_file:
+                self.index = json.load(json_file)
+
+        self.images = np.load(array_path, mmap_mode='r')
+
+    def rows(self, img_file_names):
+        """
+            Returns the store rows of the given image file names.
+        """
+        return np.array([self.index[name] for name in img_file_names], dtype=np.int64)
+
+    def image(self, row):
+        """
+            Returns one image as a uint8 view of the memory map (no copy).
+        """
+        return self.images[row]
+
+    def batch(self, rows):
+        """
+            Returns the images at rows as one uint8 array, in the order of
+            rows. The memory map is read in ascending row order, and each
+            image is copied once, straight into its place in the batch.
+        """
+        images = np.empty((len(rows), *self.images.shape[1:]), dtype=np.uint8)
+        for i in np.argsort(rows):
+            images[i] = self.images[rows[i]]
+        return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the memory-mapped image store.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_base.yaml')
+    parser.add_argument('--interpolation', help="Resize method of the loader: 'nearest' (tf_loader) or 'bilinear' (tf_loader_concat)", default='nearest')
+    args = parser.parse_args()
+
+    print(f'Using config "{args.config}"')
+    cfg = yaml.safe_load(open(args.config, 'r'))
+    init_device(cfg)
+    build_image_store(cfg, args.interpolation)
@@ -0,0 +1,218 @@
+"""
+@author: blair
+
+Description:
+    Trains every seed in a config's seed list concurrently. The shared
+    read-only inputs (annotation caches, image store or shards, ImageNet
+    backbone weights and, with --cached, the backbone features) are built
+    once by a single preparation process. One tf_train.py /
+    tf_train_concat.py process per seed then runs in a pool sized to the
+    cores and memory of the host, and every seed writes its checkpoints,
+    history and log to its own folder. The best epoch of each seed is
+    collected into one summary.json.
+
+    Example:
+        python launch_seeds.py --config ../configs/exp_order_fusion.yaml --model fusion --cached
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import yaml
+
+SCRIPTS = {'base': 'tf_train.py', 'fusion': 'tf_train_concat.py'}
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def prepare(cfg, model, cached):
+    """
+        Builds the shared read-only inputs once, so the seed runs only read
+        them. Runs in its own process, so the launcher never holds the GPU.
+    """
+    from util_order import init_device
+    from models import build_feature_extractor
+    from feature_cache import build_features
+
+    if model == 'fusion':
+        from tf_loader_concat import CTDataset
+    else:
+        from tf_loader import CTDataset
+
+    cfg['seed'] = cfg['seed'][0]
+    init_device(cfg)
+
+    # Caches the annotations, and builds the image store or shards if enabled
+    for split in ['train', 'valid']:
+        CTDataset(cfg, split=split)
+
+    # Downloads the ImageNet weights into the Keras cache
+    extractor = build_feature_extractor()
+    if cached:
+        build_features(cfg, CTDataset.interpolation, extractor=extractor)
+
+
+def pool_size(num_runs, workers=0, threads=0, memory_gb=4):
+    """
+    Sizes the process pool and the CPU threads of each run.
+
+    Parameters:
+    - num_runs (int): Number of seeds to train
+    - workers (int): Concurrent runs, 0 = as many as the cores and memory allow
+    - threads (int): CPU threads per run, 0 = the cores split between the runs
+    - memory_gb (float): Host memory one run needs
+
+    Returns:
+    tuple: (workers, threads)
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if not workers:
+        workers = max(1, cores // threads) if threads else cores
+        try:
+            total_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+            workers = min(workers, max(1, int(total_gb // memory_gb)))
+        except (AttributeError, ValueError, OSError):
+            pass
+    workers = max(1, min(workers, num_runs))
+    threads = threads or max(1, cores // workers)
+    return workers, threads
+
+
+def history_files(out_dir, experiment):
+    """
+        History files of a seed folder, newest first. A history is named
+        after its best epoch, next to {experiment}_timeline.json.
+    """
+    histories = glob.glob(os.path.join(out_dir, f'{experiment}_[0-9]*.json'))
+    return sorted(histories, key=os.path.getmtime, reverse=True)
+
+
+def seed_summary(out_dir, experiment):
+    """
+        Best epoch (lowest val_loss) of one seed's latest history, and its
+        checkpoints.
+    """
+    histories = history_files(out_dir, experiment)
+    if not histories:
+        return {}
+    with open(histories[0]) as json_file:
+        history = json.load(json_file)
+
+    best = int(np.argmin(history['val_loss']))
+    return {
+        'history': histories[0],
+        'epochs': len(history['val_loss']),
+        'best_epoch': best + 1,
+        'val_loss': history['val_loss'][best],
+        'val_accuracy': history['val_accuracy'][best],
+        'max_val_accuracy': max(history['val_accuracy']),
+        'checkpoints': sorted(glob.glob(os.path.join(out_dir, f'{experiment}_*.h5')) +
+                              glob.glob(os.path.join(out_dir, f'{experiment}_*.npz'))),
+    }
+
+
+def train_seed(args, seed_index, seed, threads, experiment):
+    """
+        Trains one seed in its own process and returns its summary.
+    """
+    out_dir = os.path.join(args.output, f'seed_{seed_index}')
+    os.makedirs(out_dir, exist_ok=True)
+
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, SCRIPTS[args.model]),
+           '--config', args.config,
+           '--seed', str(seed_index),
+           '--output', out_dir,
+           '--threads', str(threads)]
+    if args.cached:
+        cmd.append('--cached')
+    if args.resume:
+        cmd.append('--resume')
+    else:
+        # A fresh start must not be summarized from an earlier launch's history
+        for path in history_files(out_dir, experiment):
+            os.remove(path)
+
+    # Concurrent runs share the GPU, so each one only allocates what it uses
+    env = dict(os.environ, TF_FORCE_GPU_ALLOW_GROWTH='true')
+
+    start = time.time()
+    with open(os.path.join(out_dir, 'train.log'), 'w') as log:
+        returncode = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, env=env).returncode
+    elapsed = time.time() - start
+    print(f'seed {seed_index} ({seed}) finished in {elapsed:.0f} s with exit code {returncode}')
+
+    return {
+        'seed_index': seed_index,
+        'seed': seed,
+        'returncode': returncode,
+        'seconds': round(elapsed, 1),
+        'log': os.path.join(out_dir, 'train.log'),
+        **seed_summary(out_dir, experiment),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train all seeds of a config concurrently.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_fusion.yaml')
+    parser.add_argument('--model', help="'base' (tf_train.py) or 'fusion' (tf_train_concat.py)", default='fusion')
+    parser.add_argument('--cached', help='Train the heads on cached backbone features', action='store_true')
+    parser.add_argument('--resume', help='Continue every seed from its last training state', action='store_true')
+    parser.add_argument('--output', help='Folder for the per-seed runs and summary (default runs/<experiment>)')
+    parser.add_argument('--workers', help='Concurrent runs (0 = as many as the cores and memory allow)', type=int, default=0)
+    parser.add_argument('--threads', help='CPU threads per run (0 = the cores split between the runs)', type=int, default=0)
+    parser.add_argument('--memory_gb', help='Host memory one run needs, in GB', type=float, default=4)
+    parser.add_argument('--prepare', help=argparse.SUPPRESS, action='store_true')
+    args = parser.parse_args()
+
+    print(f'Using config "{args.config}"')
+    cfg = yaml.safe_load(open(args.config, 'r'))
+
+    if args.prepare:
+        prepare(cfg, args.model, args.cached)
+        sys.exit()
+
+    experiment = cfg['experiment_name']
+    seeds = cfg['seed']
+    args.config = os.path.abspath(args.config)
+    args.output = os.path.abspath(args.output or os.path.join('runs', experiment))
+    os.makedirs(args.output, exist_ok=True)
+
+    # Build the shared inputs once, before any seed starts
+    prepare_cmd = [sys.executable, os.path.abspath(__file__), '--config', args.config, '--model', args.model, '--prepare']
+    if args.cached:
+        prepare_cmd.append('--cached')
+    subprocess.run(prepare_cmd, check=True)
+
+    workers, threads = pool_size(len(seeds), args.workers, args.threads, args.memory_gb)
+    print(f'Training {len(seeds)} seed(s), {workers} at a time with {threads} thread(s) each')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        runs = list(pool.map(
+            lambda i: train_seed(args, i, seeds[i], threads, experiment),
+            range(len(seeds))
+        ))
+
+    done = [run for run in runs if 'val_loss' in run]
+    summary = {
+        'config': args.config,
+        'experiment': experiment,
+        'model': args.model,
+        'cached': args.cached,
+        'workers': workers,
+        'threads': threads,
+        'runs': runs,
+    }
+    if done:
+        for key in ['val_loss', 'val_accuracy']:
+            values = [run[key] for run in done]
+            summary[f'mean_{key}'] = float(np.mean(values))
+            summary[f'std_{key}'] = float(np.std(values))
+
+    with open(os.path.join(args.output, 'summary.json'), 'w') as json_file:
+        json.dump(summary, json_file, indent=2)
+    print(f'Summary written to {os.path.join(args.output, "summary.json")}')
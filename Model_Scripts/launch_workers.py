@@ -0,0 +1,101 @@
+"""
+@author: blair
+
+Description:
+    Trains one seed data-parallel across several worker processes, for
+    CPU-only nodes where a single model.fit process leaves most cores idle.
+    Every worker runs tf_train.py or tf_train_concat.py with --distributed,
+    takes its share of the training rows (see CTDataset.index_dataset) and
+    all-reduces gradients with the others through MultiWorkerMirroredStrategy.
+    The cluster is passed to each worker in the TF_CONFIG environment variable.
+
+    Several local workers on one machine:
+        python launch_workers.py --config ../configs/exp_order_fusion.yaml --model fusion --workers 4
+
+    Several machines: run the same command on every host, with the same
+    --hosts list and that host's position in it as --index:
+        python launch_workers.py --model fusion --hosts node1:23456,node2:23456 --index 0
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import yaml
+from launch_seeds import SCRIPTS, SCRIPT_DIR
+
+
+def cluster_config(hosts, index):
+    """
+        TF_CONFIG of the worker at hosts[index].
+    """
+    return json.dumps({'cluster': {'worker': hosts}, 'task': {'type': 'worker', 'index': index}})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train one seed data-parallel across several worker processes.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_fusion.yaml')
+    parser.add_argument('--model', help="'base' (tf_train.py) or 'fusion' (tf_train_concat.py)", default='fusion')
+    parser.add_argument('--seed', help='Seed index', type=int, default=0)
+    parser.add_argument('--cached', help='Train the head on cached backbone features', action='store_true')
+    parser.add_argument('--resume', help='Continue from the last training state', action='store_true')
+    parser.add_argument('--output', help='Folder for the checkpoints, history and worker logs', default='.')
+    parser.add_argument('--workers', help='Local worker processes', type=int, default=2)
+    parser.add_argument('--port', help='First port of the local workers', type=int, default=23456)
+    parser.add_argument('--hosts', help='Comma-separated host:port of every worker, to span several machines')
+    parser.add_argument('--index', help='Position of this machine in --hosts', type=int, default=0)
+    parser.add_argument('--threads', help='CPU threads per worker (0 = the cores split between the local workers)', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.hosts:
+        hosts = args.hosts.split(',')
+        local = [args.index]
+    else:
+        hosts = [f'localhost:{args.port + i}' for i in range(args.workers)]
+        local = list(range(args.workers))
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = args.threads or max(1, cores // len(local))
+    args.config = os.path.abspath(args.config)
+    args.output = os.path.abspath(args.output)
+    os.makedirs(args.output, exist_ok=True)
+
+    # Build the shared inputs once per host, before any local worker starts
+    prepare_cmd = [sys.executable, os.path.join(SCRIPT_DIR, 'launch_seeds.py'),
+                   '--config', args.config, '--model', args.model, '--prepare']
+    if args.cached:
+        prepare_cmd.append('--cached')
+    subprocess.run(prepare_cmd, check=True)
+
+    cfg = yaml.safe_load(open(args.config, 'r'))
+    print(f"Training {cfg['experiment_name']} on {len(hosts)} worker(s), "
+          f"{len(local)} on this host with {threads} thread(s) each")
+
+    procs = []
+    for index in local:
+        cmd = [sys.executable, os.path.join(SCRIPT_DIR, SCRIPTS[args.model]),
+               '--config', args.config,
+               '--seed', str(args.seed),
+               '--output', args.output,
+               '--threads', str(threads),
+               '--distributed']
+        if args.cached:
+            cmd.append('--cached')
+        if args.resume:
+            cmd.append('--resume')
+
+        # Local workers share the CPU, so none of them may grab a GPU
+        env = dict(os.environ, TF_CONFIG=cluster_config(hosts, index))
+        if not args.hosts:
+            env['CUDA_VISIBLE_DEVICES'] = '-1'
+        log = open(os.path.join(args.output, f'worker_{index}.log'), 'w')
+        procs.append((index, log, subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)))
+
+    failed = False
+    for index, log, proc in procs:
+        returncode = proc.wait()
+        log.close()
+        print(f'worker {index} finished with exit code {returncode}')
+        failed = failed or returncode != 0
+    sys.exit(1 if failed else 0)
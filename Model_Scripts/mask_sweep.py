@@ -0,0 +1,134 @@
+"""
+@author: blair
+
+Description:
+    Evaluates every combination of checkpoint, mask file and mask weighting
+    in one run, instead of one order_eval_allmask.py run per variant. The
+    probabilities of each checkpoint come from the prediction store (see
+    prediction_store.py), or from one pass over the validation set that is
+    then stored. Each mask file is read once. Every variant is then a
+    vectorized gather, multiply and argmax (see class_mask.py), so the whole
+    cross product takes seconds once the probabilities are stored.
+
+    Writes one tidy table with a row per (experiment, checkpoint, mask,
+    weighting, metric, class). The metrics are accuracy, macro recall (over
+    the classes in the validation set, as in the eval scripts), top-3
+    accuracy, and recall per class. The 'none' mask is the unmasked model.
+
+    Example:
+        python mask_sweep.py --configs ../configs/exp_order_base.yaml ../configs/exp_order_fusion.yaml
+"""
+
+import os
+import json
+import argparse
+import yaml
+import numpy as np
+import pandas as pd
+from util_order import init_device, profile_window, predict_split
+from annotations import read_annotations, label_encoding
+from class_mask import MaskTable
+
+
+def mask_variants(mask_root, mask_files, weightings, classes):
+    """
+        Every (mask file, weighting) -> MaskTable, each file read once.
+    """
+    dna_pr = None
+    if 'weighted' in weightings:
+        with open(os.path.join(mask_root, 'dna_pr.json')) as json_file:
+            dna_pr = json.load(json_file)
+
+    variants = {}
+    for mask_file in mask_files:
+        naive = MaskTable.read(os.path.join(mask_root, mask_file))
+        for weighting in weightings:
+            variants[mask_file, weighting] = naive.weighted(dna_pr, classes) if weighting == 'weighted' else naive
+    return variants
+
+
+def mask_metrics(labels, probs, preds, num_classes):
+    """
+        Accuracy, macro recall, top-3 accuracy and per-class recall (NaN for
+        classes not in labels).
+    """
+    correct = preds == labels
+    support = np.bincount(labels, minlength=num_classes)
+    hits = np.bincount(labels[correct], minlength=num_classes)
+    present = support > 0
+    recall = np.full(num_classes, np.nan)
+    recall[present] = hits[present] / support[present]
+
+    top3 = np.argsort(probs, axis=1)[:, -3:]
+    return {
+        'accuracy': correct.mean(),
+        'macro_recall': recall[present].mean(),
+        'top3_accuracy': np.any(top3 == labels[:, np.newaxis], axis=1).mean(),
+    }, recall
+
+
+def tidy_rows(keys, metrics, recall, class_names):
+    """
+        One row per metric, and one per class for the recall.
+    """
+    rows = [{**keys, 'metric': metric, 'class': None, 'value': value} for metric, value in metrics.items()]
+    rows += [{**keys, 'metric': 'recall', 'class': name, 'value': value} for name, value in zip(class_names, recall)]
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate every checkpoint x mask x weighting combination.')
+    parser.add_argument('--configs', help='Config files of the experiments', nargs='+', default=['../configs/exp_order_base.yaml'])
+    parser.add_argument('--masks', help='Mask files, next to the annotation files', nargs='+', default=['naive.csv', 'naive_sim.csv'])
+    parser.add_argument('--weightings', help="'naive' and/or 'weighted' (DNA precision and recall from dna_pr.json)", nargs='+', default=['naive', 'weighted'])
+    parser.add_argument('--checkpoints', help='Checkpoints of each experiment, by monitor', nargs='+', default=['loss', 'acc'])
+    parser.add_argument('--states', help='Folder with a model_states subfolder per experiment', default='model_states')
+    parser.add_argument('--output', help='Results table', default='mask_sweep.csv')
+    parser.add_argument('--recompute', help='Rerun the models even if their predictions are stored', action='store_true')
+    args = parser.parse_args()
+
+    rows = []
+    for config in args.configs:
+        print(f'Using config "{config}"')
+        cfg = yaml.safe_load(open(config, 'r'))
+        init_device(cfg)
+        experiment = cfg['experiment_name']
+
+        if 'data_cols' in cfg:
+            from tf_loader_concat import CTDataset
+        else:
+            from tf_loader import CTDataset
+        test_loader = CTDataset(cfg, split='valid')
+
+        # The annotation files the loader read ({val_name}.csv for the fusion
+        # experiments), so the labels and events line up with its rows
+        Y_ordered, short_Y_ordered = label_encoding(test_loader.train_path, cfg['class_labels'], cfg['short_labels'])
+        meta = read_annotations(test_loader.anno_path, ['Event'])
+
+        variants = mask_variants(os.path.dirname(test_loader.anno_path), args.masks, args.weightings, Y_ordered)
+        ext = '.npz' if cfg.get('checkpoint_mode', 'full') == 'head' else '.h5'
+
+        for name in args.checkpoints:
+            checkpoint = os.path.join(args.states, experiment, f'{experiment}_{name}{ext}')
+            all_true, probs, event_ids = predict_split(cfg, checkpoint, test_loader, events=meta['Event'],
+                                                       callbacks=profile_window(cfg), recompute=args.recompute)
+
+            keys = dict(experiment=experiment, checkpoint=name, mask='none', weighting='none')
+            metrics, recall = mask_metrics(all_true, probs, probs.argmax(axis=1), len(Y_ordered))
+            rows += tidy_rows(keys, metrics, recall, short_Y_ordered)
+
+            # Mask rows only depend on the mask file's events
+            mask_rows = {}
+            for (mask_file, weighting), mask in variants.items():
+                if mask_file not in mask_rows:
+                    mask_rows[mask_file] = mask.rows(event_ids)
+                masked_probs, masked_preds = mask.apply(probs, mask_rows[mask_file])
+                keys = dict(experiment=experiment, checkpoint=name, mask=mask_file, weighting=weighting)
+                metrics, recall = mask_metrics(all_true, masked_probs, masked_preds, len(Y_ordered))
+                rows += tidy_rows(keys, metrics, recall, short_Y_ordered)
+                print(f"{experiment} {name} {mask_file} {weighting}: accuracy {metrics['accuracy']:.4f}, "
+                      f"macro recall {metrics['macro_recall']:.4f}, top-3 {metrics['top3_accuracy']:.4f}")
+
+    results = pd.DataFrame(rows)
+    results.to_csv(args.output, index=False)
+    print(f'{len(results)} rows written to {args.output}')
@@ -0,0 +1,159 @@
+"""
+@author: blair
+
+Description:
+    Model definitions for the baseline and fusion models. The frozen ResNet50
+    feature extractor and the trainable heads are built separately, so the
+    heads can also be trained on their own from cached features.
+    build_masked_model() wraps either model with a classification mask
+    (see class_mask.py) applied inside the graph.
+"""
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Dense, BatchNormalization, GlobalAveragePooling2D, Dropout, Activation
+from tensorflow.keras.layers import concatenate, Layer, StringLookup
+from tensorflow.keras.layers import Input
+from tensorflow.keras.applications.resnet50 import ResNet50
+from tensorflow.keras.models import Model, load_model
+from tensorflow.keras.regularizers import l2
+from head_weights import checkpoint_meta, head_params, load_head_weights
+
+FEATURE_DIM = 2048
+
+
+def build_feature_extractor():
+    """
+        Frozen ResNet50 followed by global average pooling. Outputs one
+        2048-d vector per image.
+    """
+    base_model = ResNet50(include_top = False, weights = 'imagenet')
+    for layer in base_model.layers:
+        layer.trainable = False
+
+    x = GlobalAveragePooling2D()(base_model.output)
+    return Model(inputs = base_model.input, outputs = x, name = 'resnet50_gap')
+
+
+def regularizer(weight_decay):
+    return l2(weight_decay) if weight_decay else None
+
+
+def build_head(num_class, name = 'head', hidden_size = 128, dropout = 0.3, weight_decay = 0.0):
+    """
+        Classifier head of the baseline model, taking pooled ResNet features.
+    """
+    features = Input(shape = (FEATURE_DIM,), name = 'features')
+    x = Dense(hidden_size, kernel_regularizer = regularizer(weight_decay), name = 'head_dense')(features)
+    x = BatchNormalization(name = 'head_bn')(x)
+    x = Activation('relu', name = 'head_relu')(x)
+    x = Dropout(dropout, name = 'head_dropout')(x)
+    predict = Dense(num_class, activation = "softmax", kernel_regularizer = regularizer(weight_decay), name = 'head_output')(x)
+    return Model(inputs = features, outputs = predict, name = name)
+
+
+def build_fusion_head(num_class, ncol, name = 'fusion_head', hidden_size = 128, dropout = 0.3, weight_decay = 0.0):
+    """
+        Fusion head: a small ANN for the tabular (DNA) data, concatenated with
+        the pooled ResNet features and passed to another ANN for the final
+        classification.
+    """
+    inputs = Input(shape = (ncol,), name = 'dna')
+    annx = Dense(hidden_size, kernel_regularizer = regularizer(weight_decay), name = 'dna_dense')(inputs)
+    annx = BatchNormalization(name = 'dna_bn')(annx)
+    annx = Activation('relu', name = 'dna_relu')(annx)
+    annx = Dropout(dropout, name = 'dna_dropout')(annx)
+
+    features = Input(shape = (FEATURE_DIM,), name = 'features')
+    concat = concatenate([annx, features], name = 'fusion_concat')
+
+    combined = Dense(hidden_size, kernel_regularizer = regularizer(weight_decay), name = 'head_dense')(concat)
+    combined = BatchNormalization(name = 'head_bn')(combined)
+    combined = Activation('relu', name = 'head_relu')(combined)
+    combined = Dropout(dropout, name = 'head_dropout')(combined)
+    combined = Dense(num_class, activation = "softmax", kernel_regularizer = regularizer(weight_decay), name = 'head_output')(combined)
+    return Model(inputs = [inputs, features], outputs = combined, name = name)
+
+
+def build_base_model(cfg):
+    """
+        Returns the full baseline model (image in, softmax out) and its head.
+    """
+    resnet = build_feature_extractor()
+    head = build_head(cfg['num_classes'], **head_params(cfg))
+    model = Model(inputs = resnet.input, outputs = head(resnet.output))
+    return model, head
+
+
+def build_fusion_model(cfg):
+    """
+        Returns the full fusion model ([tabular, image] in, softmax out) and
+        its head.
+    """
+    resnet = build_feature_extractor()
+    head = build_fusion_head(cfg['num_classes'], cfg['num_col'], **head_params(cfg))
+    inputs = Input(shape = (cfg['num_col'],), name = 'dna')
+    model = Model(inputs = [inputs, resnet.input], outputs = head([inputs, resnet.output]))
+    return model, head
+
+
+def load_checkpoint(path):
+    """
+        Loads a checkpoint as the full model. A full .h5 model is loaded as
+        is; a head-only .npz is reassembled onto a fresh frozen backbone.
+    """
+    if not path.endswith('.npz'):
+        return load_model(path)
+
+    weights, meta = load_head_weights(path)
+    cfg = {'num_classes': meta['num_classes'], 'num_col': meta['num_col'], **head_params(meta)}
+    if meta['model'] == 'fusion':
+        model, head = build_fusion_model(cfg)
+    else:
+        model, head = build_base_model(cfg)
+    head.set_weights(weights)
+    return model
+
+
+class EventMask(Layer):
+    """
+    Multiplies softmax probabilities by the mask row of each specimen's
+    sampling event. The (events x classes) mask is embedded in the layer, and
+    event ids (strings) are looked up in the graph. Events missing from the
+    mask get a row of ones, i.e. stay unmasked, as in MaskTable.apply.
+
+    Parameters:
+    - events (list): Sampling event of every mask row
+    - table (array): (events x classes) mask
+    """
+    def __init__(self, events, table, **kwargs):
+        super(EventMask, self).__init__(**kwargs)
+        self.events = [str(event) for event in events]
+        table = np.asarray(table, dtype=np.float32)
+        self.lookup = StringLookup(vocabulary=self.events, num_oov_indices=1)
+        # Row 0 is the out-of-vocabulary row of the lookup
+        rows = np.concatenate([np.ones((1, table.shape[1]), np.float32), table])
+        self.table = self.add_weight(name='mask_table', shape=rows.shape, dtype=tf.float32, trainable=False,
+                                     initializer=tf.keras.initializers.Constant(rows))
+
+    def call(self, inputs):
+        probs, events = inputs
+        return probs * tf.gather(self.table, self.lookup(events))
+
+    def get_config(self):
+        config = super(EventMask, self).get_config()
+        config.update({'events': self.events, 'table': self.table.numpy()[1:].tolist()})
+        return config
+
+
+def build_masked_model(model, mask):
+    """
+        Wraps a full model with a MaskTable: an extra 'event' input (string
+        sampling event ids) goes in before the model's own inputs, and the
+        masked probabilities and masked predictions come out of one forward
+        pass.
+    """
+    event = Input(shape = (), dtype = tf.string, name = 'event')
+    masked = EventMask(np.asarray(mask.events).astype(str), mask.dense(), name = 'event_mask')([model.output, event])
+    predict = tf.argmax(masked, axis = 1, name = 'masked_prediction')
+    return Model(inputs = [event] + model.inputs, outputs = [masked, predict], name = f'{model.name}_masked')
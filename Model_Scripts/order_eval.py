@@ -17,16 +17,16 @@ import yaml
 import argparse
 import tensorflow as tf
 import numpy as np
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import classification_report, confusion_matrix
 from tf_loader import CTDataset   # Leave this, it helps for some reason
-from util_order import conf_table, plt_conf
+from util_order import conf_table, plt_conf, init_device, profile_window, predict_split
+from annotations import label_encoding
 
 
 parser = argparse.ArgumentParser(description='Train deep learning model.')
 parser.add_argument('--config', help='Path to config file', default='../configs')
 parser.add_argument('--exp', help='Experiment name', default='exp_order_base')
+parser.add_argument('--recompute', help='Rerun the model even if its predictions are stored', action='store_true')
 args = parser.parse_args()
 
 # load config
@@ -36,14 +36,15 @@ cfg_path = os.path.join(
     args.exp)
 cfg = yaml.safe_load(open(cfg_path + ".yaml"))
 
+init_device(cfg)
+
 # Unpacking config
 experiment = cfg['experiment_name']
 data_root = cfg['data_root']
 seed = cfg['seed']
 
 # setup entities
-test_loader = CTDataset(cfg, split='valid')   
-test_generator = test_loader.create_tf_dataset()
+test_loader = CTDataset(cfg, split='valid')
 
 # load validation annotation file
 annoPath = os.path.join(
@@ -57,48 +58,31 @@ trainPath = os.path.join(
     os.path.dirname(annoPath),
     'train.csv'
 )
-train  = pd.read_csv(trainPath)      
 
-# Getting long (i.e. hierarchical) class names
+# Getting long (i.e. hierarchical) class names, ordered as they are encoded,
+# and the short written class names in the same order
 class_labels = cfg['class_labels']
-Y = train[class_labels]
-Y = Y.unique()
-
-# Encoding class labels as numeric values
-encoder = LabelEncoder()
-encoder.fit(Y)
-labelIndex = encoder.transform(Y)
-
-# Getting short written class names
 short_labels = cfg['short_labels']
-short_Y = train[short_labels]
-short_Y = short_Y.unique()
+Y_ordered, short_Y_ordered = label_encoding(trainPath, class_labels, short_labels)
 
-# Ordering short class names
-Y_ordered = sorted(Y)
-short_Y_ordered = [0] * len(short_Y)
-for i in labelIndex:
-    short_Y_ordered[labelIndex[i]] = short_Y[i]
 
-# Getting ground truth numeric class labels
-all_true = []
-for idx, (data, labels) in enumerate(test_generator):
+# Checkpoint to evaluate
+if cfg.get('checkpoint_mode', 'full') == 'head':
+    # Head-only checkpoint, reassembled onto the frozen backbone
+    checkpoint = f'model_states\{experiment}\{experiment}_loss.npz'
+else:
+    checkpoint = f'model_states\{experiment}\{experiment}_loss_w.h5'
 
-    all_true.append(labels)
-all_true = tf.concat(all_true, axis=0)
-all_true = tf.argmax(all_true, axis=1)
-all_true = all_true.numpy()
+# Get ground truth numeric class labels and softmax values, from the
+# prediction store or from one pass over the validation set
+all_true, probs, _ = predict_split(cfg, checkpoint, test_loader,
+                                   callbacks=profile_window(cfg), recompute=args.recompute)
 
 # Getting named long and short class names
 named_true_long = [Y_ordered[index] for index in all_true]
 named_true_short = [Y_ordered[index] for index in all_true]
-  
-
-# load model
-model = tf.keras.models.load_model(f'model_states\{experiment}\{experiment}_loss_w.h5')
 
-# Get softmax values and classifications
-probs = model.predict(test_generator)
+# Get classifications
 predicted_classes = tf.argmax(probs, axis=1)
 predicted_classes = predicted_classes.numpy()
 
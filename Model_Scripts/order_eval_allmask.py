@@ -17,29 +17,33 @@ import json
 import argparse
 import tensorflow as tf
 import numpy as np
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import classification_report, confusion_matrix
 from tf_loader import CTDataset
-from util_order import conf_table, plt_conf
+from util_order import conf_table, plt_conf, init_device, profile_window, predict_split, event_hook
+from annotations import read_annotations, label_encoding
+from class_mask import MaskTable
+from models import load_checkpoint, build_masked_model
 
 parser = argparse.ArgumentParser(description='Train deep learning model.')
 parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_base.yaml')
 parser.add_argument('--mask', help='Experiment name', default='naive')
+parser.add_argument('--in-graph', help='Apply the mask inside the model, in the same forward pass', action='store_true')
+parser.add_argument('--recompute', help='Rerun the model even if its predictions are stored', action='store_true')
 args = parser.parse_args()
 
 # load config
 print(f'Using config "{args.config}"')
 cfg = yaml.safe_load(open(args.config, 'r'))
 
+init_device(cfg)
+
 # Unpacking config
 experiment = cfg['experiment_name']
 data_root = cfg['data_root']
 seed = cfg['seed']
 
 # setup entities
-test_loader = CTDataset(cfg, split='valid')   
-test_generator = test_loader.create_tf_dataset()
+test_loader = CTDataset(cfg, split='valid')
  
 # load validation annotation file
 annoPath = os.path.join(
@@ -47,43 +51,41 @@ annoPath = os.path.join(
     cfg["annotate_root"],
     'valid.csv'
 )
-meta = pd.read_csv(annoPath)
+meta = read_annotations(annoPath, ['Event'])
 
 # Load training annotations
 trainPath = os.path.join(
     os.path.dirname(annoPath),
     'train.csv'
 )
-train  = pd.read_csv(trainPath)      
 
-# Getting long (i.e. hierarchical) class names
+# Getting long (i.e. hierarchical) class names, ordered as they are encoded,
+# and the short written class names in the same order
 class_labels = cfg['class_labels']
-Y = train[class_labels]
-Y = Y.unique()
-
-# Encoding class labels as numeric values
-encoder = LabelEncoder()
-encoder.fit(Y)
-labelIndex = encoder.transform(Y)
-
-# Getting short written class names
 short_labels = cfg['short_labels']
-short_Y = train[short_labels]
-short_Y = short_Y.unique()
-
-# Ordering short class names
-Y_ordered = sorted(Y)
-short_Y_ordered = [0] * len(short_Y)
-for i in labelIndex:
-    short_Y_ordered[labelIndex[i]] = short_Y[i]
-
-# Getting ground truth numeric class labels
-all_true = []
-for idx, (data, labels) in enumerate(test_generator):
-    all_true.append(labels)
-all_true = tf.concat(all_true, axis=0)
-all_true = tf.argmax(all_true, axis=1)
-all_true = all_true.numpy()
+Y_ordered, short_Y_ordered = label_encoding(trainPath, class_labels, short_labels)
+
+# Checkpoint to evaluate
+if cfg.get('checkpoint_mode', 'full') == 'head':
+    # Head-only checkpoint, reassembled onto the frozen backbone
+    checkpoint = f'model_states\{experiment}\{experiment}_loss.npz'
+else:
+    checkpoint = f'model_states\{experiment}\{experiment}_loss_w.h5'
+
+if args.in_graph:
+    # The masked model is the only pass over the validation set, so the
+    # ground truth numeric class labels and sampling events come straight
+    # from the loader, in the same (annotation) order
+    all_true = test_loader.label_index
+    event_ids = np.asarray(meta['Event'])
+else:
+    # Get ground truth numeric class labels, softmax values and the sampling
+    # event of every specimen, from the prediction store or from one pass over
+    # the validation set
+    all_true, probs, event_ids = predict_split(cfg, checkpoint, test_loader, events=meta['Event'],
+                                               callbacks=profile_window(cfg), recompute=args.recompute)
+    predicted_classes = tf.argmax(probs, axis=1)
+    predicted_classes = predicted_classes.numpy()
 
 # Getting named long and short class names
 named_true_long = [Y_ordered[index] for index in all_true]
@@ -98,30 +100,14 @@ mhePath = os.path.join(
     os.path.dirname(annoPath),
     'naive_sim.csv'
 )
-# Load CSV into a pandas DataFrame
-mhe_df = pd.read_csv(mhePath)
-
-# Touching up the data frame a bit
-events = mhe_df["event"]
-mhe_df = mhe_df.drop("event", axis = 1)
-mhe_df.columns = range(mhe_df.shape[1])
-mhe_df = mhe_df.applymap(lambda x: 1 if x > 0 else x)
-mhe_df['event'] = events
-
-# Converting the data frame to a dictionary
-mhe_dict = {}
-for index, row in mhe_df.iterrows():
-    category = row['event']
-    values = row[:-1].tolist()
-    mhe_dict[category] = values
-
-# Create a dictionary to store the index mapping for each sampling event
-event_indices = {event: [] for event in set(meta['Event'])}
-for i, event in enumerate(meta['Event']):
-    event_indices[event].append(i)
-
-# Dictionary using sampling events only found in the validation data
-filtered_mhe_dict = {key: value for key, value in mhe_dict.items() if key in event_indices}
+# Loading the assemblage data as an (events x classes) mask
+mask = MaskTable.read(mhePath)
+
+# Mask row of every specimen, from its sampling event
+mask_rows = mask.rows(event_ids)
+missing = np.unique(event_ids[mask_rows < 0])
+if len(missing):
+    print(f'{len(missing)} sampling event(s) not in {mhePath}, left unmasked')
 
 # Runs weighted mask code if it is specified as the mask argument
 if(args.mask == "weighted"):
@@ -132,42 +118,24 @@ if(args.mask == "weighted"):
     # Read JSON data from file
     with open(dnaprPath) as json_file:
         dna_pr = json.load(json_file)
-    
-    for key in filtered_mhe_dict:
-        for j in range(len(filtered_mhe_dict[key])):
-            if filtered_mhe_dict[key][j]:
-                filtered_mhe_dict[key][j] = dna_pr[Y_ordered[j]]['precision']
-            else:
-                filtered_mhe_dict[key][j] = 1 - dna_pr[Y_ordered[j]]['recall']
+
+    mask = mask.weighted(dna_pr, Y_ordered)
 
 '''
 Mask code ends
 '''
-   
-# load model
-model = tf.keras.models.load_model(f'model_states\{experiment}\{experiment}_loss_w.h5')
 
-# Get softmax values and classifications
-probs = model.predict(test_generator)
-predicted_classes = tf.argmax(probs, axis=1)
-predicted_classes = predicted_classes.numpy()
-
-# Initializing 
-result_matrix = np.zeros_like(probs)
+# Masking every specimen's probabilities and getting new classifications
+if args.in_graph:
+    # The event ids travel with the images and the mask is applied in the
+    # graph, in one load of the checkpoint and one forward pass
+    test_loader.batch_hook = event_hook(event_ids, cfg['batch_size'])
+    masked_model = build_masked_model(load_checkpoint(checkpoint), mask)
+    probs, masked_preds = masked_model.predict(test_loader.create_tf_dataset(), callbacks=profile_window(cfg))
+else:
+    probs, masked_preds = mask.apply(probs, mask_rows)
 masked_pred_ohe = np.zeros_like(probs)
-
-# Iterate through the keys in 'mhe'
-for key, value_list in filtered_mhe_dict.items():
-    # Find the index for the current category
-    idx = event_indices[key]
-    # Multiply the corresponding rows by the value list
-    probs[idx, :] = probs[idx, :] * value_list
-    # Assign it to a new matrix
-    result_matrix[idx, :] = probs[idx, :]
-
-# Getting new classifications
-masked_preds = np.argmax(result_matrix, axis = 1)
-masked_pred_ohe[np.arange(len(result_matrix)), masked_preds] = 1
+masked_pred_ohe[np.arange(len(probs)), masked_preds] = 1
 
 # Measuring top 3 accuracy
 top3_indices = np.argsort(probs, axis=1)[:, -3:]
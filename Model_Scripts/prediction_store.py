@@ -0,0 +1,92 @@
+"""
+@author: blair
+
+Description:
+    Store of evaluation outputs. The softmax probabilities of a split only
+    change when the checkpoint, the annotation file, the training annotations
+    (which fix the label encoding) or the images change, so the eval scripts
+    keep them, with the true labels and the sampling event of every row, in an
+    uncompressed .npz named after a hash of those four inputs. Trying another mask, metric or plot on an evaluated model then
+    reads the .npz and never reruns the model.
+
+    Store files live in cfg['prediction_root'] (default
+    {data_root}/predictions) and can be deleted at any time.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from annotations import save_npz_atomic
+
+
+def file_hash(path, chunk_size=2**20):
+    """
+        SHA-256 of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_set_hash(cfg, img_file_names, interpolation):
+    """
+        Hash of the images of a split, in row order: their names, the size and
+        modification time of each image file, and how the loader resizes them.
+        Images missing from the image folder (e.g. read from shards only) are
+        hashed by name.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([cfg['image_size'], interpolation, cfg.get('data_cols')]).encode())
+    img_root = os.path.join(cfg['data_root'], cfg['img_path'])
+    for name in img_file_names:
+        digest.update(name.encode())
+        try:
+            stat = os.stat(os.path.join(img_root, name))
+            digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        except OSError:
+            pass
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def prediction_key(checkpoint, anno_path, train_path, image_hash):
+    """
+        Store key of one (checkpoint, annotation file, training annotations,
+        image set).
+    """
+    parts = [file_hash(checkpoint), file_hash(anno_path), file_hash(train_path), image_hash]
+    return hashlib.sha256('/'.join(parts).encode()).hexdigest()[:32]
+
+
+def store_path(cfg, key):
+    root = cfg.get('prediction_root', os.path.join(cfg['data_root'], 'predictions'))
+    return os.path.join(root, f'{key}.npz')
+
+
+def load_predictions(cfg, key):
+    """
+        Returns (labels, probs, events) stored under key, events None if
+        none were stored, or None if the key is not in the store.
+    """
+    path = store_path(cfg, key)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as stored:
+        events = stored['events'] if 'events' in stored.files else None
+        return stored['labels'], stored['probs'], events
+
+
+def save_predictions(cfg, key, labels, probs, events=None, meta=None):
+    """
+        Writes the outputs of one evaluation under key, with an optional
+        meta dict (e.g. the checkpoint path) for whoever browses the store.
+    """
+    arrays = {'labels': np.asarray(labels), 'probs': np.asarray(probs, dtype=np.float32),
+              'meta': np.array(json.dumps(meta or {}))}
+    if events is not None:
+        events = np.asarray(events)
+        arrays['events'] = events.astype(str) if events.dtype == object else events
+    save_npz_atomic(store_path(cfg, key), arrays)
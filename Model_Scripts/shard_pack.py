@@ -0,0 +1,142 @@
+"""
+@author: blair
+
+Description:
+    Packed shard archive of the image crops. The image folder holds tens of
+    thousands of small per-specimen JPEGs, and opening each one is a small,
+    syscall-heavy read that is slow on network filesystems and cold caches.
+    The packer concatenates the encoded crops into a few large shard files,
+    keeping all crops cut from the same source .tif (i.e. the same Event)
+    together, and writes an index of file name -> (shard, offset, length).
+    The loaders then read whole shards sequentially and cut the crops out of
+    memory (set image_shards: true in the config).
+
+    Pack the shards ahead of time with:
+        python shard_pack.py --config ../configs/exp_order_base.yaml
+"""
+
+import os
+import json
+import argparse
+import yaml
+import numpy as np
+from image_io import list_images
+
+
+def shard_paths(cfg):
+    """
+        Returns the shard folder and the path of its index.
+    """
+    shard_root = cfg.get('shard_root', os.path.join(cfg['data_root'], 'shards'))
+    return shard_root, os.path.join(shard_root, 'shards_index.json')
+
+
+def source_image(name):
+    """
+        Returns the source .tif a crop was cut from, e.g.
+        CLBJ_032.20160914.IB.01.IMG_01.tif.146.jpg -> CLBJ_032.20160914.IB.01.IMG_01.tif
+    """
+    head, sep, _ = name.partition('.tif.')
+    return head + '.tif' if sep else name
+
+
+def pack_shards(cfg):
+    """
+        Packs every image in the image folder into shard files of about
+        shard_mb megabytes (config, default 64). Crops of one source .tif
+        never span two shards.
+    """
+    shard_mb = cfg.get('shard_mb', 64)
+    shard_root, index_path = shard_paths(cfg)
+    os.makedirs(shard_root, exist_ok=True)
+
+    img_file_names = list_images(cfg)
+    img_dir = os.path.join(cfg['data_root'], cfg['img_path'])
+
+    groups = {}
+    for name in img_file_names:
+        groups.setdefault(source_image(name), []).append(name)
+
+    files = []
+    images = {}
+    out = None
+    for source in sorted(groups):
+        if out is None or out.tell() >= shard_mb * 2**20:
+            if out is not None:
+                out.close()
+            files.append(f'shard_{len(files):05d}.bin')
+            out = open(os.path.join(shard_root, files[-1] + '.tmp'), 'wb')
+
+        for name in groups[source]:
+            with open(os.path.join(img_dir, name), 'rb') as f:
+                encoded = f.read()
+            images[name] = [len(files) - 1, out.tell(), len(encoded)]
+            out.write(encoded)
+        print(f'{len(images)}/{len(img_file_names)}', end='\r')
+    print()
+    if out is not None:
+        out.close()
+
+    # Shards are renamed into place before the index is written, so a killed
+    # run never leaves an index pointing at partial shards
+    for name in files:
+        path = os.path.join(shard_root, name)
+        os.replace(path + '.tmp', path)
+
+    with open(index_path, 'w') as json_file:
+        json.dump({'files': files, 'images': images}, json_file)
+
+
+class ShardArchive:
+
+    def __init__(self, cfg):
+        """
+            Opens the shard index, packing the shards first if they are
+            missing or the image folder has changed.
+        """
+        shard_root, index_path = shard_paths(cfg)
+        if not os.path.exists(index_path):
+            pack_shards(cfg)
+
+        with open(index_path) as json_file:
+            index = json.load(json_file)
+
+        # Repack if images were added to or removed from the image folder
+        if sorted(index['images']) != list_images(cfg):
+            pack_shards(cfg)
+            with open(index_path) as json_file:
+                index = json.load(json_file)
+
+        self.files = [os.path.join(shard_root, name) for name in index['files']]
+        self.index = index['images']
+        self.maps = None
+
+    def locate(self, img_file_names):
+        """
+            Returns the shard, byte offset and byte length of the given image
+            file names, as int64 arrays.
+        """
+        located = np.array([self.index[name] for name in img_file_names], dtype=np.int64)
+        return located[:, 0], located[:, 1], located[:, 2]
+
+    def read(self, shard, offset, length):
+        """
+            Returns the encoded bytes of one image, read from the memory-mapped
+            shard.
+        """
+        if self.maps is None:
+            self.maps = [np.memmap(path, dtype=np.uint8, mode='r') for path in self.files]
+        return np.array(self.maps[shard][offset:offset + length].tobytes(), dtype=object)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the image crops into shard files.')
+    parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_base.yaml')
+    parser.add_argument('--shard_mb', help='Approximate size of each shard in MB (overrides the config)', type=int)
+    args = parser.parse_args()
+
+    print(f'Using config "{args.config}"')
+    cfg = yaml.safe_load(open(args.config, 'r'))
+    if args.shard_mb:
+        cfg['shard_mb'] = args.shard_mb
+    pack_shards(cfg)
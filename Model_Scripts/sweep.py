@@ -0,0 +1,425 @@
+"""
+@author: blair
+
+Description:
+    Trains the heads of several experiments (e.g. exp_order_base, _fusion,
+    _noise, _sim and _zero) in one run. The experiments use the same images
+    and differ only in the annotation CSV and the DNA columns, so every image
+    is read and decoded once and passed through the frozen ResNet50 once per
+    step, and the pooled features are fanned out to one head per experiment.
+    The heads share no trainable weights, so training them together under one
+    summed loss gives each head the gradients of its own run.
+
+    Images are decoded with the resize method of the first config's loader
+    ('nearest' for a base config, 'bilinear' for a fusion config), so put the
+    config whose images should be reproduced exactly first. Each experiment
+    writes its own checkpoints and history, as tf_train.py and
+    tf_train_concat.py do, and the best epochs are collected into
+    summary.json. Every experiment stops early on its own validation loss
+    (see HeadStopping), and the run ends once all of them have stopped.
+
+    Example:
+        python sweep.py --configs ../configs/exp_order_fusion.yaml ../configs/exp_order_base.yaml
+            ../configs/exp_order_noise.yaml ../configs/exp_order_sim.yaml ../configs/exp_order_zero.yaml
+"""
+
+import os
+import json
+import argparse
+import yaml
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications.resnet50 import preprocess_input
+from tensorflow.keras.layers import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.callbacks import Callback
+from sklearn.utils.class_weight import compute_class_weight
+from util_order import init_seed, init_device, EarlyMinStopping, FullModelCheckpoint, HeadCheckpoint, profile_window
+from image_io import decode_bytes
+from models import FEATURE_DIM, build_feature_extractor, build_head, build_fusion_head, checkpoint_meta, head_params
+from feature_cache import load_features, split_features
+from launch_seeds import seed_summary
+import tf_loader
+import tf_loader_concat
+
+# Settings that must match, since the experiments share one input pipeline
+SHARED = ['data_root', 'img_path', 'annotate_root', 'file_name', 'class_labels', 'num_classes',
+          'image_size', 'batch_size', 'seed', 'label_mode', 'learning_rate',
+          'image_store', 'image_shards', 'checkpoint_mode', 'num_epochs', 'min_epochs', 'patience',
+          'max_hours', 'max_images']
+
+
+def is_fusion(cfg):
+    """
+        Fusion configs carry the DNA columns, base configs do not.
+    """
+    return 'data_cols' in cfg
+
+
+def check_shared(cfgs):
+    """
+        Raises a ValueError if the configs differ in a shared setting.
+    """
+    for key in SHARED:
+        values = [cfg.get(key) for cfg in cfgs]
+        if any(value != values[0] for value in values[1:]):
+            raise ValueError(f"All configs of a sweep need the same '{key}', got {values}")
+
+
+class Experiment:
+    """
+        One experiment of the sweep: its config, the loaders of both splits
+        and, per split, its labels, class weights and DNA rows aligned to the
+        row order of the sweep's shared image stream.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.name = cfg['experiment_name']
+        self.fusion = is_fusion(cfg)
+
+        CTDataset = tf_loader_concat.CTDataset if self.fusion else tf_loader.CTDataset
+        self.loaders = {split: CTDataset(cfg, split=split) for split in ['train', 'valid']}
+
+        # Balanced class weights, like compute_class_weight("balanced") in
+        # the training scripts
+        y = self.loaders['train'].label_index
+        present = np.unique(y)
+        self.class_weights = np.ones(cfg['num_classes'], dtype=np.float32)
+        self.class_weights[present] = compute_class_weight(class_weight='balanced', classes=present, y=y)
+
+    def align(self, split, img_file_names):
+        """
+            Row of each of img_file_names in this experiment's annotations.
+        """
+        loader = self.loaders[split]
+        rows = {name: row for row, name in enumerate(loader.img_file_names)}
+        if len(rows) != len(img_file_names) or any(name not in rows for name in img_file_names):
+            raise ValueError(f"The {split} annotations of '{self.name}' do not list the same images "
+                             f"as the first config of the sweep")
+        return np.array([rows[name] for name in img_file_names], dtype=np.int64)
+
+    def targets(self, split, img_file_names):
+        """
+            Returns a graph function mapping a batch of shared rows to this
+            experiment's DNA rows (None for a base experiment), labels and
+            sample weights.
+        """
+        loader = self.loaders[split]
+        rows = tf.constant(self.align(split, img_file_names))
+        labels = loader.label_table()
+        weights = tf.constant(self.class_weights[loader.label_index])
+        if self.fusion:
+            table = tf.constant(loader.event_table)
+            event_index = tf.constant(loader.event_index)
+
+        def gather(shared_rows):
+            own = tf.gather(rows, shared_rows)
+            X = tf.gather(table, tf.gather(event_index, own)) if self.fusion else None
+            return X, tf.gather(labels, own), tf.gather(weights, own)
+
+        return gather
+
+
+def create_sweep_dataset(experiments, split, features=None):
+    """
+        Dataset of the shared image stream of the first experiment's loader,
+        fanned out to every experiment. Yields ([image or features, DNA rows of
+        each fusion experiment], labels per experiment) and, for training, the
+        class weights per experiment as sample weights. With features (see
+        feature_cache.py) the cached backbone features replace the images.
+    """
+    driver = experiments[0].loaders[split]
+    targets = [experiment.targets(split, driver.img_file_names) for experiment in experiments]
+
+    if features is not None:
+        # Same variant lookup as CTDataset.create_feature_dataset()
+        variants = [features['plain']]
+        if split == 'train' and 'flip' in features:
+            variants.append(features['flip'])
+        n = len(driver.img_file_names)
+        table = tf.constant(np.concatenate(variants), dtype=tf.float32)
+
+        def gather(rows, flips):
+            variant = tf.cast(flips, tf.int64) * (len(variants) - 1)
+            return rows, tf.gather(table, variant * n + rows)
+
+        data = driver.index_dataset().batch(driver.batch_size)
+        data = data.map(gather, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    elif driver.store:
+        sources = tf.constant(driver.sources())
+
+        # Whole batches read from the image store, then flipped and preprocessed
+        def load_rows(rows, flips):
+            return rows, driver.batch_augmentation(driver.load_batch(tf.gather(sources, rows)), flips)
+
+        data = driver.index_dataset().batch(driver.batch_size).map(
+            load_rows,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=driver.deterministic
+        )
+    else:
+        if driver.shards:
+            def load_encoded(row, flip, encoded):
+                img = decode_bytes(encoded, driver.img_size, driver.interpolation)
+                return (row, *driver.augment(img, flip))
+
+            data = driver.shard_dataset().map(
+                load_encoded,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=driver.deterministic
+            )
+        else:
+            sources = tf.constant(driver.sources())
+
+            def load_row(row, flip):
+                img = driver.load(tf.gather(sources, row))
+                return (row, *driver.augment(img, flip))
+
+            data = driver.index_dataset().map(
+                load_row,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=driver.deterministic
+            )
+
+        data = data.batch(driver.batch_size)
+        if driver.batch_augment:
+            data = data.map(
+                lambda rows, imgs, flips: (rows, driver.batch_augmentation(imgs, flips)),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
+        else:
+            data = data.map(
+                lambda rows, imgs: (rows, preprocess_input(tf.cast(imgs, tf.float32))),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
+
+    def fan_out(rows, imgs):
+        gathered = [gather(rows) for gather in targets]
+        inputs = (imgs, *(X for X, _, _ in gathered if X is not None))
+        labels = tuple(label for _, label, _ in gathered)
+        if split != 'train':
+            return inputs, labels
+        return inputs, labels, tuple(weight for _, _, weight in gathered)
+
+    data = data.map(fan_out, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return driver.prefetch(data)
+
+
+def build_sweep_model(experiments, cached):
+    """
+        Returns the model trained by the sweep (one input for the images or
+        cached features, one DNA input per fusion experiment, one output per
+        experiment), and the head and full model of every experiment, built
+        from the same layers, for checkpointing.
+    """
+    resnet = build_feature_extractor()
+    features = Input(shape = (FEATURE_DIM,), name = 'features') if cached else resnet.output
+    inputs = [features if cached else resnet.input]
+    outputs = []
+    heads = []
+    full_models = []
+
+    for experiment in experiments:
+        cfg = experiment.cfg
+        if experiment.fusion:
+            head = build_fusion_head(cfg['num_classes'], cfg['num_col'], name = experiment.name, **head_params(cfg))
+            dna = Input(shape = (cfg['num_col'],), name = f'{experiment.name}_dna')
+            inputs.append(dna)
+            outputs.append(head([dna, features]))
+            full_dna = Input(shape = (cfg['num_col'],), name = 'dna')
+            full_models.append(Model(inputs = [full_dna, resnet.input], outputs = head([full_dna, resnet.output])))
+        else:
+            head = build_head(cfg['num_classes'], name = experiment.name, **head_params(cfg))
+            outputs.append(head(features))
+            full_models.append(Model(inputs = resnet.input, outputs = head(resnet.output)))
+
+        heads.append(head)
+
+    return Model(inputs = inputs, outputs = outputs, name = 'sweep'), heads, full_models
+
+
+class HeadStopping(Callback):
+    """
+    Early stopping of every experiment of a sweep on its own: each head has an
+    EarlyMinStopping on its own validation loss, and once it stops, its
+    checkpoints stop too and its best weights are restored at the end, as in
+    a separate run. Training goes on until every head has stopped. A stopped
+    head keeps receiving gradients, but only its kept weights and history
+    count, which are those of its own run.
+
+    Parameters:
+    - stoppers (list): One EarlyMinStopping per experiment
+    - checkpoints (list): The checkpoint callbacks of each experiment
+    """
+    def __init__(self, stoppers, checkpoints):
+        super(HeadStopping, self).__init__()
+        self.stoppers = stoppers
+        self.checkpoints = checkpoints
+        self.active = [True] * len(stoppers)
+
+    def callbacks(self, i=None):
+        indices = range(len(self.stoppers)) if i is None else [i]
+        return [cb for j in indices for cb in self.checkpoints[j] + [self.stoppers[j]]]
+
+    def set_model(self, model):
+        super(HeadStopping, self).set_model(model)
+        for callback in self.callbacks():
+            callback.set_model(model)
+
+    def on_train_begin(self, logs=None):
+        for callback in self.callbacks():
+            callback.on_train_begin(logs)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        for i in range(len(self.stoppers)):
+            if self.active[i]:
+                for callback in self.callbacks(i):
+                    callback.on_epoch_begin(epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        for i, stopper in enumerate(self.stoppers):
+            if not self.active[i]:
+                continue
+            for callback in self.callbacks(i):
+                callback.on_epoch_end(epoch, logs)
+            if stopper.stop_reason != 'num_epochs':
+                self.active[i] = False
+        # The stoppers stop the whole model, which only the last one may do
+        self.model.stop_training = not any(self.active)
+
+    def on_train_end(self, logs=None):
+        for callback in self.callbacks():
+            callback.on_train_end(logs)
+
+    def epochs(self, i):
+        """
+            Epochs experiment i trained for in its own run.
+        """
+        stopper = self.stoppers[i]
+        return stopper.stopped_epoch + 1 if stopper.stop_reason != 'num_epochs' else None
+
+
+def split_history(history, experiments):
+    """
+        Splits the Keras history of the sweep model into one history per
+        experiment, with the keys a single training run would have.
+    """
+    if len(experiments) == 1:
+        return [dict(history)]
+
+    histories = []
+    for experiment in experiments:
+        own = {}
+        for key in ['loss', 'accuracy']:
+            own[key] = history[f'{experiment.name}_{key}']
+            own[f'val_{key}'] = history[f'val_{experiment.name}_{key}']
+        histories.append(own)
+    return histories
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the heads of several experiments in one pass over the images.')
+    parser.add_argument('--configs', help='Paths to the config files', nargs='+',
+                        default=['../configs/exp_order_fusion.yaml', '../configs/exp_order_base.yaml',
+                                 '../configs/exp_order_noise.yaml', '../configs/exp_order_sim.yaml',
+                                 '../configs/exp_order_zero.yaml'])
+    parser.add_argument('--seed', help='Seed index', type=int, default = 0)
+    parser.add_argument('--cached', help='Train the heads on cached backbone features', action='store_true')
+    parser.add_argument('--output', help='Folder for the checkpoints, histories and summary', default='.')
+    args = parser.parse_args()
+
+    cfgs = []
+    for path in args.configs:
+        print(f'Using config "{path}"')
+        cfgs.append(yaml.safe_load(open(path, 'r')))
+    check_shared(cfgs)
+    names = [cfg['experiment_name'] for cfg in cfgs]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Experiment names of a sweep must be unique, got {names}')
+
+    for cfg in cfgs:
+        cfg['seed'] = cfg['seed'][args.seed]
+    init_device(cfgs[0])
+    for cfg in cfgs[1:]:
+        for key in ['device', 'intra_op_threads', 'inter_op_threads', 'data_threads']:
+            cfg[key] = cfgs[0][key]
+    seed = cfgs[0]['seed']
+
+    # Setting the seed
+    init_seed(seed)
+
+    experiments = [Experiment(cfg) for cfg in cfgs]
+    driver = experiments[0].loaders['train']
+    print(f"Sweeping {len(experiments)} experiment(s) over one {driver.interpolation} image stream: {', '.join(names)}")
+
+    if args.cached:
+        index, features = load_features(cfgs[0], driver.interpolation)
+        train_data = create_sweep_dataset(experiments, 'train', split_features(driver.img_file_names, index, features))
+        valid_names = experiments[0].loaders['valid'].img_file_names
+        valid_data = create_sweep_dataset(experiments, 'valid', split_features(valid_names, index, features))
+    else:
+        train_data = create_sweep_dataset(experiments, 'train')
+        valid_data = create_sweep_dataset(experiments, 'valid')
+
+    model, heads, full_models = build_sweep_model(experiments, args.cached)
+
+    # Setting parameters
+    learning_rate = cfgs[0]['learning_rate']
+    optimizer = Adam(learning_rate=learning_rate)
+    epochs = cfgs[0]['num_epochs']
+
+    # Integer labels in sparse label mode, one-hot vectors otherwise
+    sparse = cfgs[0].get('label_mode', 'categorical') == 'sparse'
+    loss = 'sparse_categorical_crossentropy' if sparse else 'categorical_crossentropy'
+
+    model.compile(optimizer = optimizer, loss = [loss] * len(experiments), metrics = ['accuracy'])
+
+    # The best loss and accuracy checkpoints of every experiment, each saving
+    # the full model of that experiment, or its head in head checkpoint mode,
+    # and the early stopping of every experiment on its own validation loss
+    # or, for all of them, on the compute budget, restoring its best head
+    os.makedirs(args.output, exist_ok=True)
+    head_only = cfgs[0].get('checkpoint_mode', 'full') == 'head'
+    stoppers, checkpoints = [], []
+    for experiment, head, full_model in zip(experiments, heads, full_models):
+        prefix = '' if len(experiments) == 1 else f'{experiment.name}_'
+        own = []
+        for metric in ['loss', 'acc']:
+            monitor = f"val_{prefix}{'loss' if metric == 'loss' else 'accuracy'}"
+            if head_only:
+                path = os.path.join(args.output, f'{experiment.name}_{metric}.npz')
+                meta = checkpoint_meta(experiment.cfg, experiment.fusion)
+                own.append(HeadCheckpoint(head, path, meta, monitor=monitor, save_best_only=True))
+            else:
+                path = os.path.join(args.output, f'{experiment.name}_{metric}.h5')
+                own.append(FullModelCheckpoint(full_model, path, monitor=monitor, save_best_only=True))
+        checkpoints.append(own)
+        stoppers.append(EarlyMinStopping(cfgs[0].get('min_epochs', 0), cfgs[0].get('patience', epochs),
+                                         monitor=f'val_{prefix}loss',
+                                         max_seconds=3600 * cfgs[0].get('max_hours', 0),
+                                         max_images=cfgs[0].get('max_images', 0),
+                                         images_per_epoch=len(driver.img_file_names), restore=[head]))
+    stopping = HeadStopping(stoppers, checkpoints)
+    callbacks = [stopping]
+
+    # Model fitting
+    history = model.fit(train_data,
+                        epochs = epochs,
+                        verbose = 1,
+                        validation_data = valid_data,
+                        callbacks = callbacks + profile_window(cfgs[0]))
+
+    # Finding the best epoch of each experiment and saving
+    summary = {'configs': [os.path.abspath(path) for path in args.configs], 'seed': seed, 'cached': args.cached, 'runs': []}
+    for i, (experiment, own) in enumerate(zip(experiments, split_history(history.history, experiments))):
+        # Only the epochs of the experiment's own run, up to its early stop
+        own = {key: values[:stopping.epochs(i)] for key, values in own.items()}
+        best_epoch = np.argmin(own['val_loss']) + 1
+        with open(os.path.join(args.output, f'{experiment.name}_{best_epoch}.json'), 'w') as json_file:
+            json.dump(dict(own, **stoppers[i].summary()), json_file)
+        summary['runs'].append({'experiment': experiment.name, **seed_summary(args.output, experiment.name)})
+
+    with open(os.path.join(args.output, 'summary.json'), 'w') as json_file:
+        json.dump(summary, json_file, indent=2)
+    print(f'Summary written to {os.path.join(args.output, "summary.json")}')
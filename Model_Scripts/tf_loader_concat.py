@@ -7,15 +7,20 @@ Description:
 
 import tensorflow as tf
 import os
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder
+import numpy as np
 #from tensorflow.keras.preprocessing.image import load_img, img_to_array
 from tensorflow.keras.applications.resnet50 import preprocess_input
 from tensorflow.data import Dataset
-from tensorflow.keras.utils import to_categorical
+from image_io import decode_image, decode_bytes, preprocess_uint8
+from image_store import ImageStore
+from shard_pack import ShardArchive
+from annotations import read_annotations, annotation_columns, label_encoding, encode_labels, event_table
 
 class CTDataset:
 
+    # tf.image.resize defaults to bilinear
+    interpolation = 'bilinear'
+
     def __init__(self, cfg, split='train'):
         '''
             Constructor. Here, we collect and index the dataset inputs and
@@ -28,11 +33,19 @@ class CTDataset:
         self.img_size = cfg['image_size']
         self.batch_size = cfg['batch_size']
         self.seed = cfg['seed']
+        self.device = cfg.get('device', 'cuda')
+        self.data_threads = cfg.get('data_threads', 0)
+        self.sparse = cfg.get('label_mode', 'categorical') == 'sparse'
+        self.batch_augment = cfg.get('batch_augment', False)
         
         self.num_col = cfg['num_col']
         
         self.split = split
         
+        # Parallel decoding may return training samples out of order, which
+        # is a little faster. Validation order always matches the annotations.
+        self.deterministic = cfg.get('deterministic', True) if self.split == 'train' else True
+        
         train_name = cfg["train_name"]
         val_name = cfg["val_name"]
         
@@ -48,71 +61,344 @@ class CTDataset:
             f'{train_name}.csv'
         )
         
-        meta = pd.read_csv(anno_path)
-        train = pd.read_csv(train_path)
-        
-        data_cols = range(cfg['data_cols'][0], cfg['data_cols'][1])
-        
-        X = meta.iloc[:, data_cols].values
-        X = tf.constant(X, dtype=tf.float32)
-        
+        # Only the columns we need are read from the columnar cache
+        data_cols = annotation_columns(anno_path)[cfg['data_cols'][0]:cfg['data_cols'][1]]
         class_labels = cfg['class_labels']
-        Y_train = train[class_labels]
-        encoder = LabelEncoder()
-        encoder.fit(Y_train)
+        file_name = cfg['file_name']
+        meta = read_annotations(anno_path, [file_name, class_labels, 'Event'] + data_cols)
         
-        Y = meta[class_labels]
-        label_index = encoder.transform(Y)
-        encoded_Y = to_categorical(label_index)
+        self.events, self.event_table, self.event_index = event_table(meta, data_cols)
         
-        file_name = cfg['file_name']
-        img_file_names = meta[file_name].tolist()
+        # Annotation files this split was read from, for the eval scripts
+        # (e.g. the prediction store key and the mask events)
+        self.anno_path = anno_path
+        self.train_path = train_path
+        
+        # Class encoding of the training annotations, shared by all splits
+        self.classes, _ = label_encoding(train_path, class_labels)
         
-        self.data = list(zip(X, img_file_names, encoded_Y))
+        self.label_index = encode_labels(meta[class_labels], self.classes)
+        self.img_file_names = meta[file_name].tolist()
+
+        # Read pre-resized uint8 images from the memory-mapped store if enabled
+        self.store = ImageStore(cfg, self.interpolation) if cfg.get('image_store', False) else None
+        self.image_dtype = tf.uint8 if self.store else tf.float32
+
+        # Or read the encoded images sequentially from the packed shards
+        self.shards = ShardArchive(cfg) if cfg.get('image_shards', False) else None
+        self.shard_cycle = cfg.get('shard_cycle', 4)
+        if self.store and self.shards:
+            raise ValueError('Set only one of image_store and image_shards')
+
+        # Number of passes over the training data so far. Each pass shuffles
+        # and flips with its own seed, see index_dataset().
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+        # Optional last stage of the pipeline, see prefetch()
+        self.batch_hook = None
 
-    def create_tf_dataset(self):
+        # Data-parallel workers each train on their own share of the rows,
+        # see util_order.init_strategy
+        self.num_shards = cfg.get('num_shards', 1)
+        self.shard_index = cfg.get('shard_index', 0)
+
+    def create_tf_dataset(self, legacy=False):
         '''
-            Create a TensorFlow dataset.
+            Create a TensorFlow dataset. The lightweight (row, flip) index
+            stream is shuffled first; images are then read and decoded in a
+            parallel map inside the graph, and stay uint8 until
+            preprocess_input. With the image store, the index stream is
+            batched first and each batch is read from the store in one call.
+            legacy=True builds the old single-threaded Python generator
+            instead, which is only kept for bench_loader.py.
         '''
         
-        data = Dataset.from_generator(
-            self.generator,
-            output_signature=(
-                (
-                    tf.TensorSpec(shape=(None,), dtype=tf.float32),
-                    tf.TensorSpec(shape=(None, None, None), dtype=tf.float32),
-                ),
-                tf.TensorSpec(shape=(None,), dtype=tf.float32),
+        if legacy:
+            data = Dataset.from_generator(
+                self.generator,
+                output_signature=(
+                    (
+                        tf.TensorSpec(shape=(None,), dtype=tf.float32),
+                        tf.TensorSpec(shape=(None, None, None), dtype=self.image_dtype),
+                    ),
+                    self.label_spec(),
+                )
             )
-        )
+            if self.split == 'train':
+                data = data.shuffle(buffer_size = 1000)
+                data = data.map(
+                    lambda Data, label: ((Data[0], tf.image.random_flip_left_right(Data[1])), label),
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE
+                    )
+        elif self.shards:
+            event_index = tf.constant(self.event_index)
+            labels = self.label_table()
+
+            def load_encoded(row, flip, encoded):
+                img = decode_bytes(encoded, self.img_size, self.interpolation)
+                return (tf.gather(event_index, row), *self.augment(img, flip)), tf.gather(labels, row)
+
+            data = self.shard_dataset().map(
+                load_encoded,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=self.deterministic
+            )
+        elif self.store:
+            event_index = tf.constant(self.event_index)
+            table = tf.constant(self.event_table)
+            sources = tf.constant(self.sources())
+            labels = self.label_table()
 
-        # Shuffle and batch the dataset
-        if self.split == 'train':
-            data = data.shuffle(buffer_size = 1000)
+            def load_rows(rows, flips):
+                imgs = self.load_batch(tf.gather(sources, rows))
+                X = tf.gather(table, tf.gather(event_index, rows))
+                return (X, self.batch_augmentation(imgs, flips)), tf.gather(labels, rows)
+
+            # Already batched and preprocessed
+            data = self.index_dataset().batch(self.batch_size).map(
+                load_rows,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=self.deterministic
+            )
+            return self.prefetch(data)
+        else:
+            event_index = tf.constant(self.event_index)
+            sources = tf.constant(self.sources())
+            labels = self.label_table()
+
+            # Only the event index travels with each sample, the DNA rows are
+            # gathered per batch below
+            def load_row(row, flip):
+                img = self.load(tf.gather(sources, row))
+                return (tf.gather(event_index, row), *self.augment(img, flip)), tf.gather(labels, row)
+
+            data = self.index_dataset().map(
+                load_row,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=self.deterministic
+            )
+        
+        if self.batch_augment and not legacy:
+            # Batch first, then flip and preprocess whole batches while the
+            # DNA rows are gathered
+            table = tf.constant(self.event_table)
+            data = data.batch(self.batch_size)
+            data = data.map(
+                lambda Data, labels: ((tf.gather(table, Data[0]), self.batch_augmentation(Data[1], Data[2])), labels),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
+        else:
+            # Preprocess images and labels
             data = data.map(
-                self.data_augmentation,
+                lambda Data, labels: (self.preprocess_fn(Data), labels),
                 num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
+
+            # Batch data
+            data = data.batch(self.batch_size)
+            if not legacy:
+                table = tf.constant(self.event_table)
+                data = data.map(
+                    lambda Data, labels: ((tf.gather(table, Data[0]), Data[1]), labels),
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE
                 )
-        
-        # Preprocess images and labels
-        data = data.map(
-            lambda Data, labels: (self.preprocess_fn(Data), labels),
-            num_parallel_calls=tf.data.experimental.AUTOTUNE
-        )
 
-        # Batch data
-        data = data.batch(self.batch_size)
-        
-        # Prefetch data to the GPU (assuming you have GPU support)
-        data = data.apply(tf.data.experimental.prefetch_to_device("/gpu:0"))
-        
+        return self.prefetch(data)
+
+    def create_feature_dataset(self, features):
+        '''
+            Create a TensorFlow dataset of cached backbone features instead of
+            images. features maps each augmentation variant ('plain', 'flip')
+            to an array in the same row order as this split. During training
+            the flip drawn by index_dataset() picks the variant.
+        '''
+        variants = [features['plain']]
+        if self.split == 'train' and 'flip' in features:
+            variants.append(features['flip'])
+
+        n = len(self.img_file_names)
+        table = tf.constant(np.concatenate(variants), dtype=tf.float32)
+        dna = tf.constant(self.event_table)
+        event_index = tf.constant(self.event_index)
+        labels = self.label_table()
+
+        data = self.index_dataset().batch(self.batch_size)
+
+        def gather(rows, flips):
+            variant = tf.cast(flips, tf.int64) * (len(variants) - 1)
+            feats = tf.gather(table, variant * n + rows)
+            X = tf.gather(dna, tf.gather(event_index, rows))
+            return (X, feats), tf.gather(labels, rows)
+
+        data = data.map(gather, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        return self.prefetch(data)
+
+    def prefetch(self, data):
+        '''
+            Prefetch to the GPU when training on one, otherwise into host
+            memory, and run the pipeline on its own thread pool if the config
+            sizes one (see util_order.init_device). A batch_hook, e.g.
+            ThroughputMonitor.stamp, is applied just before the prefetch.
+        '''
+        if self.batch_hook is not None:
+            data = self.batch_hook(data)
+
+        if self.device == 'cuda' and tf.config.list_physical_devices('GPU'):
+            data = data.apply(tf.data.experimental.prefetch_to_device("/gpu:0"))
+        else:
+            data = data.prefetch(tf.data.experimental.AUTOTUNE)
+
+        options = tf.data.Options()
+        if self.data_threads:
+            options.threading.private_threadpool_size = self.data_threads
+        if self.num_shards > 1:
+            # Rows are already split between the workers, see index_dataset()
+            options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        data = data.with_options(options)
+
         return data
 
+    def label_table(self):
+        '''
+            Labels of every row: int32 class indices in sparse label mode,
+            float32 one-hot vectors otherwise.
+        '''
+        if self.sparse:
+            return tf.constant(self.label_index)
+        return tf.one_hot(self.label_index, self.num_class)
+
+    def label_spec(self):
+        '''
+            TensorSpec of one label, for the legacy generator.
+        '''
+        if self.sparse:
+            return tf.TensorSpec(shape=(), dtype=tf.int32)
+        return tf.TensorSpec(shape=(self.num_class,), dtype=tf.float32)
+
+    def sources(self):
+        '''
+            What load_batch() or load() reads each image from: rows of the
+            image store, or image file paths.
+        '''
+        if self.store:
+            return self.store.rows(self.img_file_names)
+        return [os.path.join(self.data_root, self.img_path, name) for name in self.img_file_names]
+
+    def index_dataset(self):
+        '''
+            Stream of (row, flip) pairs, before any image is loaded. For
+            training, each pass draws a new permutation and new flips from
+            (seed, epoch), so shuffling is cheap and reproducible. Setting
+            self.epoch replays the order of that epoch. A data-parallel
+            worker takes every num_shards-th row of the epoch's order, and
+            all workers get the same number of rows so they run the same
+            number of steps.
+        '''
+        n = len(self.img_file_names)
+        if self.split != 'train':
+            return Dataset.range(n).map(lambda row: (row, tf.constant(False)))
+
+        def epoch_order(_):
+            epoch = self.epoch.assign_add(1) - 1
+            seed = tf.stack([tf.constant(self.seed, tf.int64), epoch])
+            draws = tf.random.stateless_uniform([2, n], seed=seed)
+            order = tf.argsort(draws[0])
+            if self.num_shards > 1:
+                order = order[self.shard_index:(n // self.num_shards) * self.num_shards:self.num_shards]
+            return Dataset.from_tensor_slices((tf.cast(order, tf.int64), tf.gather(draws[1], order) < 0.5))
+
+        return Dataset.range(1).flat_map(epoch_order)
+
+    def shard_dataset(self):
+        '''
+            Stream of (row, flip, encoded image) read from the shard archive.
+            For training, each pass shuffles the shards and the rows within
+            each shard from (seed, epoch), like index_dataset(). Every shard
+            is read whole in one sequential read, and shard_cycle shards are
+            read and interleaved in parallel. Other splits keep annotation
+            order and cut each image out of the memory-mapped shards.
+        '''
+        n = len(self.img_file_names)
+        shard, offset, length = self.shards.locate(self.img_file_names)
+
+        if self.split != 'train':
+            located = tf.constant(np.stack([shard, offset, length], axis=1))
+
+            def read(row, flip):
+                encoded = tf.numpy_function(self.shards.read, tf.unstack(tf.gather(located, row)), tf.string)
+                encoded.set_shape(())
+                return row, flip, encoded
+
+            return self.index_dataset().map(read, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        # Rows of the i-th shard used by this split are by_shard[starts[i]:ends[i]]
+        used = np.unique(shard)
+        by_shard = np.argsort(shard, kind='stable')
+        files = tf.constant([self.shards.files[s] for s in used])
+        starts = tf.constant(np.searchsorted(shard[by_shard], used, side='left'))
+        ends = tf.constant(np.searchsorted(shard[by_shard], used, side='right'))
+        by_shard = tf.constant(by_shard)
+        offset = tf.constant(offset)
+        length = tf.constant(length)
+
+        def epoch_order(_):
+            epoch = self.epoch.assign_add(1) - 1
+            seed = tf.stack([tf.constant(self.seed, tf.int64), epoch])
+            draws = tf.random.stateless_uniform([3, n], seed=seed)
+
+            # A data-parallel worker keeps the rows index_dataset() would give it
+            rank = tf.argsort(tf.argsort(draws[0]))
+            mine = (rank % self.num_shards == self.shard_index) & (rank < (n // self.num_shards) * self.num_shards)
+
+            def read_shard(i):
+                rows = by_shard[starts[i]:ends[i]]
+                if self.num_shards > 1:
+                    rows = tf.boolean_mask(rows, tf.gather(mine, rows))
+                rows = tf.gather(rows, tf.argsort(tf.gather(draws[0], rows)))
+                blob = tf.io.read_file(files[i])
+                return Dataset.from_tensor_slices((rows, tf.gather(draws[1], rows) < 0.5)).map(
+                    lambda row, flip: (row, flip, tf.strings.substr(blob, offset[row], length[row]))
+                )
+
+            order = tf.argsort(draws[2][:len(used)])
+            return Dataset.from_tensor_slices(tf.cast(order, tf.int64)).interleave(
+                read_shard,
+                cycle_length=self.shard_cycle,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=self.deterministic
+            )
+
+        return Dataset.range(1).flat_map(epoch_order)
+
+    def load(self, source):
+        '''
+            Load one image file (graph function) as uint8.
+        '''
+        return decode_image(source, self.img_size, self.interpolation)
+
+    def load_batch(self, sources):
+        '''
+            Load a batch of images from the image store (graph function) as
+            uint8, in one call for the whole batch (see ImageStore.batch).
+        '''
+        imgs = tf.numpy_function(self.store.batch, [sources], tf.uint8)
+        imgs.set_shape((None, *self.img_size, 3))
+        return imgs
+
     def generator(self):
         '''
             Generator function for the TensorFlow dataset.
         '''
-        for X, image_name, label in self.data:
+        labels = self.label_index if self.sparse else np.eye(self.num_class, dtype=np.float32)[self.label_index]
+        X_rows = self.event_table[self.event_index]
+        for X, image_name, label in zip(X_rows, self.img_file_names, labels):
+            if self.store:
+                # uint8 view of the memory-mapped store, no decode
+                img = self.store.image(self.store.index[image_name])
+                yield ((X, img), label)
+                continue
+
             # Load image
             image_path = os.path.join(self.data_root, self.img_path, image_name)
             img = tf.io.read_file(image_path)
@@ -122,16 +408,37 @@ class CTDataset:
 
             yield ((X, img), label)
     
-    def data_augmentation(self, Data, label):
+    def augment(self, img, flip):
+        '''
+            Per-sample augmentation, as a 1-tuple so it can be unpacked into
+            the sample. With batch_augment the drawn flip is passed on to
+            batch_augmentation() instead.
+        '''
+        if self.batch_augment:
+            return img, flip
+        return (self.data_augmentation(img, flip),)
+
+    def data_augmentation(self, img, flip):
         """
-            Apply data augmentation (randomly flip left-right) to the image.
+            Apply data augmentation (flip left-right if drawn) to the image.
         """
-        X, img = Data
-        img = tf.image.random_flip_left_right(img)
-        return (X, img), label
+        return tf.cond(flip, lambda: tf.image.flip_left_right(img), lambda: img)
+
+    def batch_augmentation(self, imgs, flips):
+        '''
+            Flip the drawn samples of a whole uint8 batch, then preprocess
+            the batch. Only the drawn samples are reversed, and the
+            preprocessing runs on uint8 (see image_io.preprocess_uint8).
+        '''
+        imgs = tf.map_fn(
+            lambda sample: tf.cond(sample[1], lambda: tf.reverse(sample[0], axis=[1]), lambda: sample[0]),
+            (imgs, flips),
+            fn_output_signature=tf.uint8
+        )
+        return preprocess_uint8(imgs)
     
     def preprocess_fn(self, Data):
         X, img = Data
-        img = preprocess_input(img)  # Apply preprocessing to img
+        img = preprocess_input(tf.cast(img, tf.float32))  # Apply preprocessing to img
         return (X, img)  # Return the updated structure
 
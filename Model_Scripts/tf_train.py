@@ -5,27 +5,34 @@ Description:
     Training script for baseline model.
 """
 
-from tensorflow.keras.layers import Dense, BatchNormalization, GlobalAveragePooling2D, Dropout, Activation
-from tensorflow.keras.callbacks import ModelCheckpoint
-from tensorflow.keras.applications.resnet50 import ResNet50
-from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
-import pandas as pd
 import numpy as np
 import os
-os.chdir(r"C:\Users\au761482\OneDrive - Aarhus universitet\Documents\GitHub_repos\CV-eDNA-Hybrid\Model_Scripts")
+# Working folder on the author's machine; elsewhere (e.g. the worker and
+# seed processes of launch_workers.py / launch_seeds.py) the current folder is kept
+workdir = r"C:\Users\au761482\OneDrive - Aarhus universitet\Documents\GitHub_repos\CV-eDNA-Hybrid\Model_Scripts"
+if os.path.isdir(workdir):
+    os.chdir(workdir)
 
 import json
 import argparse
 import yaml
-from util_order import init_seed
+from util_order import init_seed, init_device, init_strategy, EarlyMinStopping, FullModelCheckpoint, HeadCheckpoint, ResumeCheckpoint, ThroughputMonitor, profile_window
 from tf_loader import CTDataset
+from models import build_base_model, checkpoint_meta
+from feature_cache import load_features, split_features
+from annotations import read_annotations
 
 from sklearn.utils.class_weight import compute_class_weight
 
 parser = argparse.ArgumentParser(description='Train deep learning model.')
 parser.add_argument('--config', help='Path to config file', default='../configs/exp_order_base.yaml')
 parser.add_argument('--seed', help='Seed index', type=int, default = 0)
+parser.add_argument('--cached', help='Train the head on cached backbone features', action='store_true')
+parser.add_argument('--output', help='Folder for the checkpoints and history', default='.')
+parser.add_argument('--threads', help='CPU threads for this run, overrides the config (0 = from the config)', type=int, default=0)
+parser.add_argument('--resume', help='Continue from the last training state in the output folder', action='store_true')
+parser.add_argument('--distributed', help='Train data-parallel across the workers in TF_CONFIG (see launch_workers.py)', action='store_true')
 args = parser.parse_args()
 
 # load config
@@ -34,11 +41,20 @@ cfg = yaml.safe_load(open(args.config, 'r'))
 
 # Unpacking some stuff from the config
 cfg["seed"] = cfg["seed"][args.seed]
+if args.threads:
+    cfg['intra_op_threads'] = cfg['data_threads'] = args.threads
+init_device(cfg)
+strategy = init_strategy(cfg, args.distributed)
 seed = cfg["seed"]
 batch_size = cfg["batch_size"]
 num_class = cfg["num_classes"]
 experiment = cfg["experiment_name"]
 
+# Every data-parallel worker saves the same replica; only worker 0 writes to
+# the output folder itself
+if cfg['shard_index']:
+    args.output = os.path.join(args.output, f"worker_{cfg['shard_index']}")
+
 output_file = f'{experiment}.txt'
 
 # Path to the image annotations
@@ -49,7 +65,7 @@ anno_path = os.path.join(
 )
 
 # Reading in the annotations and setting class weights
-meta = pd.read_csv(anno_path)
+meta = read_annotations(anno_path, ["longlab"])
 classes = meta["longlab"].values
 class_weights = compute_class_weight(class_weight="balanced", classes=np.unique(classes), y=classes)
 class_weights = dict(enumerate(class_weights))
@@ -61,46 +77,81 @@ init_seed(seed)
 train_loader = CTDataset(cfg, split='train')
 valid_loader = CTDataset(cfg, split='valid')
 
-# Create a TensorFlow dataset
-train_data = train_loader.create_tf_dataset()
-valid_data = valid_loader.create_tf_dataset()
-
-# Define ResNet for image data
-base_model = ResNet50(include_top = False, weights = 'imagenet')
-x = base_model.output
-x = GlobalAveragePooling2D()(x)
-x = Dense(128)(x)
-x = BatchNormalization()(x)
-x = Activation('relu')(x)
-x = Dropout(0.3)(x)
-predict = Dense(num_class, activation = "softmax")(x)
-model = Model(inputs = base_model.input, outputs = predict)
-
-for layer in base_model.layers:
-    layer.trainable = False
-
-# Setting parameters
-learning_rate = cfg['learning_rate']
-optimizer = Adam(learning_rate=learning_rate)
-epochs = 150
-
-model.compile(optimizer = optimizer, loss = 'categorical_crossentropy', metrics = ['accuracy'])
-
-# We save the models with the best loss and accuracy in case of weird outliers
-cp_loss = ModelCheckpoint(f'{experiment}_loss.h5', monitor='val_loss', save_best_only=True)
-cp_acc = ModelCheckpoint(f'{experiment}_acc.h5', monitor='val_accuracy', save_best_only=True)
+# Times every training step and epoch, see util_order.ThroughputMonitor
+monitor = ThroughputMonitor(os.path.join(args.output, f'{experiment}_timeline.json'),
+                            batch_size, num_images=len(train_loader.img_file_names))
+train_loader.batch_hook = monitor.stamp
+
+# Create a TensorFlow dataset. In cached mode the frozen backbone is run once
+# (see feature_cache.py) and the head is trained on the stored features.
+if args.cached:
+    index, features = load_features(cfg, CTDataset.interpolation)
+    train_data = train_loader.create_feature_dataset(split_features(train_loader.img_file_names, index, features))
+    valid_data = valid_loader.create_feature_dataset(split_features(valid_loader.img_file_names, index, features))
+else:
+    train_data = train_loader.create_tf_dataset()
+    valid_data = valid_loader.create_tf_dataset()
+
+# The model, optimizer and their variables are mirrored across the workers
+# when training data-parallel
+with strategy.scope():
+    # Define ResNet for image data, with the classifier head on top
+    model, head = build_base_model(cfg)
+    fit_model = head if args.cached else model
+
+    # Setting parameters
+    learning_rate = cfg['learning_rate']
+    optimizer = Adam(learning_rate=learning_rate)
+    epochs = cfg['num_epochs']
+
+    # Integer labels in sparse label mode, one-hot vectors otherwise
+    sparse = cfg.get('label_mode', 'categorical') == 'sparse'
+    loss = 'sparse_categorical_crossentropy' if sparse else 'categorical_crossentropy'
+
+    fit_model.compile(optimizer = optimizer, loss = loss, metrics = ['accuracy'])
+
+# We save the models with the best loss and accuracy in case of weird outliers.
+# In head checkpoint mode only the head's weights are written, off the
+# training thread, and models.load_checkpoint() rebuilds the full model.
+os.makedirs(args.output, exist_ok=True)
+if cfg.get('checkpoint_mode', 'full') == 'head':
+    meta = checkpoint_meta(cfg, fusion=False)
+    cp_loss = HeadCheckpoint(head, os.path.join(args.output, f'{experiment}_loss.npz'), meta, monitor='val_loss', save_best_only=True)
+    cp_acc = HeadCheckpoint(head, os.path.join(args.output, f'{experiment}_acc.npz'), meta, monitor='val_accuracy', save_best_only=True)
+else:
+    cp_loss = FullModelCheckpoint(model, os.path.join(args.output, f'{experiment}_loss.h5'), monitor='val_loss', save_best_only=True)
+    cp_acc = FullModelCheckpoint(model, os.path.join(args.output, f'{experiment}_acc.h5'), monitor='val_accuracy', save_best_only=True)
+monitor.checkpoints = [cp_loss, cp_acc]
+
+# Stops a plateaued run after min_epochs/patience, or when another epoch
+# would overrun the compute budget, and restores the best head
+stopper = EarlyMinStopping(cfg.get('min_epochs', 0), cfg.get('patience', epochs), monitor='val_loss',
+                           max_seconds=3600 * cfg.get('max_hours', 0), max_images=cfg.get('max_images', 0),
+                           images_per_epoch=len(train_loader.img_file_names), restore=[head])
+
+# Periodic training state (head, Adam, epoch, data order, RNG, history), so a
+# preempted run can continue with --resume
+resume = ResumeCheckpoint(os.path.join(args.output, f'{experiment}_state'), head, optimizer,
+                          train_loader.epoch, callbacks=[cp_loss, cp_acc, stopper], every=cfg.get('resume_every', 1))
+initial_epoch = resume.restore() if args.resume else resume.reset()
 
 # Model fitting
-history = model.fit(train_data,
-                    epochs = epochs, 
+history = fit_model.fit(train_data,
+                    epochs = epochs,
+                    initial_epoch = initial_epoch,
                     verbose = 1,
                     validation_data = valid_data,
                     callbacks = [cp_loss,
-                                 cp_acc],
+                                 cp_acc,
+                                 monitor,
+                                 stopper,
+                                 resume] + profile_window(cfg),
                     class_weight=class_weights)
 
 # Finding the best epoch and saving
-best_epoch = np.argmin(history.history['val_loss']) + 1
-with open(f'{experiment}_{best_epoch}.json', 'w') as json_file:
-    json.dump(history.history, json_file)
+# (the full history, including epochs from before a resume, and why
+# training stopped)
+best_epoch = np.argmin(resume.history['val_loss']) + 1
+with open(os.path.join(args.output, f'{experiment}_{best_epoch}.json'), 'w') as json_file:
+    json.dump(dict(resume.history, **stopper.summary()), json_file)
 
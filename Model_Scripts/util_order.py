@@ -6,18 +6,27 @@ Description:
     Utility functions for model training and evaluation scripts.
 """
 import os
+import json
 import math
+import time
 import copy
 import random
+import shutil
+import psutil
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import tensorflow as tf
-from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.callbacks import Callback, ModelCheckpoint
 
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import seaborn as sns
 from IPython.display import clear_output
+from head_weights import save_head_weights
+from annotations import save_npz_atomic
+from prediction_store import image_set_hash, prediction_key, load_predictions, save_predictions
+from models import load_checkpoint
 
 def init_seed(seed):
     
@@ -26,38 +35,726 @@ def init_seed(seed):
     np.random.seed(seed)
     tf.random.set_seed(seed)
     
+def init_device(cfg):
+    """
+    Configures TensorFlow for the device and thread settings in the config,
+    and prints the chosen layout. Call it before any TensorFlow op runs.
+
+    A 'cuda' device falls back to CPU on hosts without a GPU. Intra-op and
+    tf.data thread counts of 0 (or missing) are sized to the cores available
+    to this process; an inter-op count of 0 is 2, as each op already spreads
+    over the intra-op pool. The resolved values are written back into cfg
+    for the loaders.
+
+    Parameters:
+    - cfg (dict): The experiment config
+
+    Returns:
+    dict: cfg, with device, intra_op_threads, inter_op_threads and
+    data_threads resolved
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    gpus = tf.config.list_physical_devices('GPU')
+
+    device = cfg.get('device', 'cuda')
+    if device == 'cuda' and not gpus:
+        print('No GPU found, falling back to CPU')
+        device = 'cpu'
+    if device == 'cpu' and gpus:
+        tf.config.set_visible_devices([], 'GPU')
+
+    cfg['device'] = device
+    cfg['intra_op_threads'] = cfg.get('intra_op_threads') or cores
+    cfg['inter_op_threads'] = cfg.get('inter_op_threads') or 2
+    cfg['data_threads'] = cfg.get('data_threads') or cores
+
+    tf.config.threading.set_intra_op_parallelism_threads(cfg['intra_op_threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(cfg['inter_op_threads'])
+
+    print(f"Device: {device} ({len(gpus)} GPU(s), {cores} cores available) | "
+          f"intra-op threads: {cfg['intra_op_threads']} | "
+          f"inter-op threads: {cfg['inter_op_threads']} | "
+          f"tf.data threads: {cfg['data_threads']}")
+
+    return cfg
+
+def init_strategy(cfg, distributed=False):
+    """
+    Returns the distribution strategy to build and compile the model under.
+    With distributed=True it is a MultiWorkerMirroredStrategy over the
+    cluster in the TF_CONFIG environment variable (see launch_workers.py):
+    every worker trains a replica of the model on its own share of the
+    training rows and gradients are all-reduced each step. Call it after
+    init_device and before any other TensorFlow op runs.
+
+    Parameters:
+    - cfg (dict): The experiment config
+    - distributed (bool): Train data-parallel across the TF_CONFIG workers
+
+    Returns:
+    Strategy: The strategy; cfg gets num_shards and shard_index for the
+    loaders
+    """
+    if not distributed:
+        cfg['num_shards'], cfg['shard_index'] = 1, 0
+        return tf.distribute.get_strategy()
+
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    if not tf_config.get('cluster', {}).get('worker'):
+        raise ValueError('Distributed training needs a TF_CONFIG with a worker cluster, see launch_workers.py')
+
+    # Ring all-reduce works on CPU-only hosts
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+    cfg['num_shards'] = len(tf_config['cluster']['worker'])
+    cfg['shard_index'] = tf_config['task']['index']
+    print(f"Worker {cfg['shard_index']} of {cfg['num_shards']} | "
+          f"replicas in sync: {strategy.num_replicas_in_sync}")
+    return strategy
+
 class EarlyMinStopping(Callback):
-    def __init__(self, min_epochs, patience, monitor='val_loss'):
+    """
+    Stops training once the monitored metric has not improved for `patience`
+    epochs, but never before `min_epochs`. It can also hold a run to a
+    compute budget of wall-clock seconds or training images; the run stops
+    at the end of the last epoch that fits the budget. When a run stops
+    early, the weights of the best epoch are restored into the given models
+    (the heads), and stop_reason records why training ended: 'patience',
+    'time_budget', 'image_budget' or 'num_epochs'.
+
+    Parameters:
+    - min_epochs (int): Epochs before patience can stop the run
+    - patience (int): Epochs without improvement before stopping
+    - monitor (str): Metric to monitor, lower is better
+    - max_seconds (float): Wall-clock budget of the run, 0 = none
+    - max_images (int): Training images budget of the run, 0 = none
+    - images_per_epoch (int): Training images per epoch, for max_images
+    - restore (list): Models whose weights are restored to the best epoch
+    """
+    def __init__(self, min_epochs, patience, monitor='val_loss', max_seconds=0, max_images=0,
+                 images_per_epoch=0, restore=()):
         super(EarlyMinStopping, self).__init__()
         self.min_epochs = min_epochs
         self.patience = patience
         self.monitor = monitor
+        self.max_seconds = max_seconds
+        self.max_images = max_images
+        self.images_per_epoch = images_per_epoch
+        self.restore = list(restore)
+        # Set here rather than in on_train_begin, so ResumeCheckpoint can
+        # restore them before training starts
+        self.best = float('inf')
         self.wait = 0
+        self.images_seen = 0
+        self.seconds_used = 0.0
+        self.best_epoch = None
+        self.best_weights = None
         self.stopped_epoch = 0
+        self.stop_reason = 'num_epochs'
 
-    def on_epoch_end(self, epoch, logs=None):
-        if epoch < self.min_epochs:
-            return
+    def on_train_begin(self, logs=None):
+        self.start = time.perf_counter() - self.seconds_used
 
-        current_value = logs.get(self.monitor)
+    def on_epoch_end(self, epoch, logs=None):
+        current_value = (logs or {}).get(self.monitor)
         if current_value is None:
             raise ValueError(f"Early stopping monitor '{self.monitor}' not found in logs.")
 
+        self.seconds_used = time.perf_counter() - self.start
+        self.images_seen += self.images_per_epoch
+
         if current_value < self.best:
             self.best = current_value
             self.wait = 0
-        else:
+            self.best_epoch = epoch
+            self.best_weights = [model.get_weights() for model in self.restore]
+        elif epoch >= self.min_epochs:
             self.wait += 1
             if self.wait >= self.patience:
-                self.stopped_epoch = epoch
-                self.model.stop_training = True
+                self.stop(epoch, 'patience')
+                return
 
-    def on_train_begin(self, logs=None):
-        self.best = float('inf')
+        # Stop if another epoch would overrun a budget
+        epoch_seconds = self.seconds_used / (epoch + 1)
+        if self.max_seconds and self.seconds_used + epoch_seconds > self.max_seconds:
+            self.stop(epoch, 'time_budget')
+        elif self.max_images and self.images_seen + self.images_per_epoch > self.max_images:
+            self.stop(epoch, 'image_budget')
+
+    def stop(self, epoch, reason):
+        self.stopped_epoch = epoch
+        self.stop_reason = reason
+        self.model.stop_training = True
+
+    def on_train_end(self, logs=None):
+        if self.stop_reason == 'num_epochs':
+            return
+        print(f"Training stopped after {self.stopped_epoch + 1} epochs ({self.stop_reason}).")
+        if self.best_weights is not None:
+            for model, weights in zip(self.restore, self.best_weights):
+                model.set_weights(weights)
+            print(f"Restored the weights of epoch {self.best_epoch + 1} ({self.monitor} = {self.best:.4f}).")
+
+    def summary(self):
+        """
+            Why and when training ended, for the history JSON.
+        """
+        return {
+            'stop_reason': self.stop_reason,
+            'stopped_epoch': self.stopped_epoch + 1 if self.stop_reason != 'num_epochs' else None,
+            'seconds_used': self.seconds_used,
+            'images_seen': self.images_seen,
+        }
+
+class FullModelCheckpoint(ModelCheckpoint):
+    """
+    ModelCheckpoint that monitors the model being fit, but saves another model
+    built from the same layers. Used when only the head is trained on cached
+    features, so the saved .h5 still holds the full ResNet50 model.
+    """
+    def __init__(self, full_model, filepath, **kwargs):
+        super(FullModelCheckpoint, self).__init__(filepath, **kwargs)
+        self.full_model = full_model
+        self.write_seconds = 0.0
+
+    def set_model(self, model):
+        super(FullModelCheckpoint, self).set_model(self.full_model)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Time spent saving, reported by ThroughputMonitor
+        start = time.perf_counter()
+        super(FullModelCheckpoint, self).on_epoch_end(epoch, logs)
+        self.write_seconds += time.perf_counter() - start
+
+class HeadCheckpoint(Callback):
+    """
+    Checkpoint of the trainable head only. The ResNet50 backbone is frozen at
+    its ImageNet weights, so saving it every time the monitored metric
+    improves only rewrites ~100 MB that never change. This copies the head's
+    weights (a few MB) on the training thread, writes them to an .npz on a
+    background thread, and records which backbone and head to rebuild them
+    into. models.load_checkpoint() reassembles the full model.
+
+    Parameters:
+    - head (Model): The head (or fusion head) whose weights are saved
+    - filepath (str): .npz file to write
+    - meta (dict): How to rebuild the full model, see head_weights.checkpoint_meta
+    - monitor (str): Metric to monitor
+    - save_best_only (bool): Only save when the monitored metric improves
+    """
+    def __init__(self, head, filepath, meta, monitor='val_loss', save_best_only=True):
+        super(HeadCheckpoint, self).__init__()
+        self.head = head
+        self.filepath = filepath
+        self.meta = meta
+        self.monitor = monitor
+        self.save_best_only = save_best_only
+        # Like ModelCheckpoint's mode='auto'
+        self.higher_better = 'acc' in monitor
+        self.best = -np.inf if self.higher_better else np.inf
+        self.write_seconds = 0.0
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        start = time.perf_counter()
+        current = (logs or {}).get(self.monitor)
+        if current is None:
+            print(f"HeadCheckpoint: '{self.monitor}' not found in logs, skipping")
+            return
+        improved = current > self.best if self.higher_better else current < self.best
+        if improved or not self.save_best_only:
+            if improved:
+                self.best = current
+            # Copy on this thread, so training can go on while it is written
+            weights = [np.array(w) for w in self.head.get_weights()]
+            meta = dict(self.meta, epoch=epoch + 1, monitor=self.monitor, value=float(current))
+            self.pending = self.writer.submit(save_head_weights, self.filepath, weights, meta)
+        self.write_seconds += time.perf_counter() - start
+
+    def on_train_end(self, logs=None):
+        # Wait for the last write, and raise if it failed
+        if self.pending is not None:
+            self.pending.result()
+
+class ThroughputMonitor(Callback):
+    """
+    Records where the time of each training epoch goes, to tell whether
+    training is input-bound or compute-bound. Per step it records the wall
+    time and the time spent waiting for the batch; per epoch the images/sec,
+    validation time, checkpoint write time and peak RSS. Prints a summary
+    after every epoch and writes the timeline to a JSON file.
+
+    The input wait of a step is how long after the step began its batch
+    left the input pipeline. Set stamp() as the loaders' batch_hook before
+    creating the training dataset, so batches are timed as they are made.
+
+    Parameters:
+    - path (str): JSON file for the timeline
+    - batch_size (int): Images per full batch
+    - num_images (int): Images per training epoch, so the last batch counts right
+    - checkpoints (list): FullModelCheckpoint or HeadCheckpoint callbacks to time
+    """
+    def __init__(self, path, batch_size, num_images=None, checkpoints=()):
+        super(ThroughputMonitor, self).__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self.num_images = num_images
+        self.checkpoints = list(checkpoints)
+        self.process = psutil.Process()
+        # Times each batch was ready, appended by the input pipeline
+        self.ready = []
+        self.step_count = 0
+        self.steps = {'epoch': [], 'step': [], 'seconds': [], 'input_wait': []}
+        self.epochs = []
+
+    def stamp(self, data):
+        """
+            Adds a stage to the end of a tf.data pipeline (before prefetch)
+            that notes when each batch is ready.
+        """
+        def note(*batch):
+            ready = tf.numpy_function(self._note, [], tf.float64)
+            with tf.control_dependencies([ready]):
+                return tf.nest.map_structure(tf.identity, batch)
+
+        return data.map(note)
+
+    def _note(self):
+        now = time.perf_counter()
+        self.ready.append(now)
+        return np.float64(now)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.epoch_steps = 0
+        self.epoch_images = 0
+        self.epoch_wait = 0.0
+        self.val_seconds = 0.0
+        self.peak_rss = self.process.memory_info().rss
+        self.written = sum(cp.write_seconds for cp in self.checkpoints)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        # Batches are made and used in order, so the k-th step ran on the
+        # k-th batch made. Without stamp() the wait is unknown.
+        wait = None
+        if self.step_count < len(self.ready):
+            wait = max(0.0, min(self.ready[self.step_count], end) - self.step_start)
+            self.epoch_wait += wait
+        self.step_count += 1
+
+        images = self.batch_size
+        if self.num_images:
+            images = min(images, self.num_images - self.epoch_images)
+        self.epoch_images += images
+        self.epoch_steps += 1
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+        self.steps['epoch'].append(len(self.epochs) + 1)
+        self.steps['step'].append(batch)
+        self.steps['seconds'].append(end - self.step_start)
+        self.steps['input_wait'].append(wait)
+
+    def on_test_begin(self, logs=None):
+        self.val_start = time.perf_counter()
+
+    def on_test_end(self, logs=None):
+        self.val_seconds += time.perf_counter() - self.val_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.epoch_start
+        train_seconds = sum(self.steps['seconds'][-self.epoch_steps:]) if self.epoch_steps else 0.0
+        checkpoint_seconds = sum(cp.write_seconds for cp in self.checkpoints) - self.written
+        timed = self.steps['input_wait'][-self.epoch_steps:] if self.epoch_steps else []
+        waited = None if None in timed else self.epoch_wait
+
+        self.epochs.append({
+            'epoch': epoch + 1,
+            'seconds': seconds,
+            'train_seconds': train_seconds,
+            'steps': self.epoch_steps,
+            'images': self.epoch_images,
+            'images_per_sec': self.epoch_images / train_seconds if train_seconds else None,
+            'input_wait_seconds': waited,
+            'input_wait_fraction': waited / train_seconds if waited is not None and train_seconds else None,
+            'val_seconds': self.val_seconds,
+            'checkpoint_seconds': checkpoint_seconds,
+            'peak_rss_mb': self.peak_rss / 2**20,
+        })
+
+        summary = self.epochs[-1]
+        wait = 'input wait n/a' if waited is None else f"input wait {100 * summary['input_wait_fraction']:.0f}%"
+        print(f"Epoch {epoch + 1}: {summary['images_per_sec'] or 0:.1f} images/sec | "
+              f"step {train_seconds / max(1, self.epoch_steps):.3f} s | {wait} | "
+              f"val {self.val_seconds:.1f} s | checkpoints {checkpoint_seconds:.1f} s | "
+              f"peak RSS {summary['peak_rss_mb']:.0f} MB")
+
+        # Rewritten every epoch, so a killed run keeps its timeline
+        self.save()
+
+    def save(self):
+        with open(self.path, 'w') as json_file:
+            json.dump({'steps': self.steps, 'epochs': self.epochs}, json_file)
+
+class ResumeCheckpoint(Callback):
+    """
+    Periodic training state, so a preempted run can continue where it left
+    off. Every `every` epochs it saves the trainable head, the optimizer
+    (Adam moments and step count), the loader's epoch counter (which sets the
+    shuffle and flip order of the next epoch), the Python and NumPy RNG
+    states, the history so far, and the best values of the checkpoint and
+    early stopping callbacks, including the best head weights
+    EarlyMinStopping restores when it stops. The frozen backbone is rebuilt from its ImageNet weights and
+    is not saved. Each state is written by tf.train.CheckpointManager, which
+    only points at a new state once it is complete, and its JSON sidecar is
+    written before that.
+
+    Dropout draws from TensorFlow's op-level random state, which cannot be
+    saved, so dropout masks after a resume differ from an uninterrupted run.
+
+    Parameters:
+    - directory (str): Folder for the states
+    - head (Model): The trainable head (or the whole fit model)
+    - optimizer (Optimizer): The optimizer of the fit model
+    - data_epoch (tf.Variable): CTDataset.epoch of the training loader
+    - callbacks (list): Callbacks whose best/wait (and budget) values are saved
+    - every (int): Epochs between states
+    - keep (int): States kept on disk
+    """
+    def __init__(self, directory, head, optimizer, data_epoch, callbacks=(), every=1, keep=2):
+        super(ResumeCheckpoint, self).__init__()
+        self.directory = directory
+        self.checkpoint = tf.train.Checkpoint(head=head, optimizer=optimizer, data_epoch=data_epoch)
+        self.callbacks = list(callbacks)
+        self.every = every
+        self.keep = keep
+        self.manager = None
+        self.history = {}
+
+    def reset(self):
+        """
+            Starts from scratch, removing earlier states. Returns the
+            initial epoch, 0.
+        """
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, self.directory, max_to_keep=self.keep)
+        return 0
+
+    def restore(self):
+        """
+            Restores the latest complete state, if any. Returns the epoch to
+            continue from, for model.fit(initial_epoch=...).
+        """
+        self.manager = tf.train.CheckpointManager(self.checkpoint, self.directory, max_to_keep=self.keep)
+        for path in reversed(self.manager.checkpoints):
+            if not os.path.exists(f'{path}.json'):
+                continue
+            with open(f'{path}.json') as json_file:
+                state = json.load(json_file)
+
+            # Optimizer slots are restored as soon as Keras creates them
+            self.checkpoint.restore(path)
+            self.history = state['history']
+            version, internal, gauss = state['python_rng']
+            random.setstate((version, tuple(internal), gauss))
+            name, keys, pos, has_gauss, cached = state['numpy_rng']
+            np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+            for callback, values in zip(self.callbacks, state['callbacks']):
+                for key, value in values.items():
+                    setattr(callback, key, value)
+            self.restore_best_weights(path, state.get('best_weights', []))
+
+            print(f"Resuming after epoch {state['epoch']} from {path}")
+            return state['epoch']
+
+        print(f'No training state in {self.directory}, starting from scratch')
+        return 0
+
+    def callback_state(self, callback):
+        state = {}
+        for key, cast in [('best', float), ('wait', int), ('images_seen', int), ('seconds_used', float),
+                          ('best_epoch', int)]:
+            if getattr(callback, key, None) is not None:
+                state[key] = cast(getattr(callback, key))
+        return state
+
+    def save_best_weights(self, path):
+        """
+            Writes the best_weights of the callbacks that keep them (e.g.
+            EarlyMinStopping) to {path}.best.npz. Returns the number of
+            weights of each of their models, per callback (None for
+            callbacks without best weights).
+        """
+        arrays, layout = {}, []
+        for i, callback in enumerate(self.callbacks):
+            best_weights = getattr(callback, 'best_weights', None)
+            if best_weights is None:
+                layout.append(None)
+                continue
+            layout.append([len(weights) for weights in best_weights])
+            for j, weights in enumerate(best_weights):
+                for k, w in enumerate(weights):
+                    arrays[f'c{i}_m{j}_w{k}'] = w
+        if arrays:
+            save_npz_atomic(f'{path}.best.npz', arrays)
+        return layout
+
+    def restore_best_weights(self, path, layout):
+        if not any(layout):
+            return
+        with np.load(f'{path}.best.npz') as arrays:
+            for i, (callback, counts) in enumerate(zip(self.callbacks, layout)):
+                if counts is not None:
+                    callback.best_weights = [[arrays[f'c{i}_m{j}_w{k}'] for k in range(count)]
+                                             for j, count in enumerate(counts)]
+
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+        if (epoch + 1) % self.every:
+            return
+        if self.manager is None:
+            self.reset()
+
+        name, keys, pos, has_gauss, cached = np.random.get_state()
+        state = {
+            'epoch': epoch + 1,
+            'history': self.history,
+            'python_rng': random.getstate(),
+            'numpy_rng': [name, keys.tolist(), pos, has_gauss, cached],
+            'callbacks': [self.callback_state(callback) for callback in self.callbacks],
+        }
+
+        # The sidecars go first: the manager only lists the state once its
+        # files are complete
+        path = os.path.join(self.directory, f'ckpt-{epoch + 1}')
+        os.makedirs(self.directory, exist_ok=True)
+        state['best_weights'] = self.save_best_weights(path)
+        with open(f'{path}.json.tmp', 'w') as json_file:
+            json.dump(state, json_file)
+        os.replace(f'{path}.json.tmp', f'{path}.json')
+        self.manager.save(checkpoint_number=epoch + 1)
+
+        # Drop the sidecars of states the manager has deleted
+        kept = {f'{kept_path}{ext}' for kept_path in self.manager.checkpoints for ext in ['.json', '.best.npz']}
+        for sidecar in os.listdir(self.directory):
+            sidecar = os.path.join(self.directory, sidecar)
+            if sidecar.endswith(('.json', '.best.npz')) and sidecar not in kept:
+                os.remove(sidecar)
+
+class ProfileWindow(Callback):
+    """
+    Captures a tf.profiler trace (host ops, tf.data stages, device ops and
+    memory) of a window of steps. Steps are counted over every training and
+    prediction batch, so the same window works for model.fit and
+    model.predict. The trace opens in TensorBoard's Profile tab.
+
+    Parameters:
+    - log_dir (str): Folder for the trace
+    - start_step (int): First step traced
+    - num_steps (int): Number of steps traced
+    - host_tracer_level (int): Detail of the host trace, 1 to 3
+    """
+    def __init__(self, log_dir, start_step=10, num_steps=5, host_tracer_level=2):
+        super(ProfileWindow, self).__init__()
+        self.log_dir = log_dir
+        self.start_step = start_step
+        self.stop_step = start_step + num_steps
+        self.options = tf.profiler.experimental.ProfilerOptions(host_tracer_level=host_tracer_level,
+                                                                python_tracer_level=0,
+                                                                device_tracer_level=1)
+        self.step = 0
+        self.tracing = False
+
+    def start(self):
+        if self.step == self.start_step and not self.tracing:
+            tf.profiler.experimental.start(self.log_dir, options=self.options)
+            self.tracing = True
+
+    def stop(self, finished=False):
+        if self.tracing and (finished or self.step >= self.stop_step):
+            tf.profiler.experimental.stop()
+            self.tracing = False
+            print(f"Profiler trace of steps {self.start_step}-{self.step - 1} written to {self.log_dir}")
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        self.stop()
+
+    def on_predict_batch_begin(self, batch, logs=None):
+        self.start()
+
+    def on_predict_batch_end(self, batch, logs=None):
+        self.step += 1
+        self.stop()
 
     def on_train_end(self, logs=None):
-        if self.stopped_epoch > 0:
-            print(f"Training stopped after {self.stopped_epoch + 1} epochs without improvement.")
+        self.stop(finished=True)
+
+    def on_predict_end(self, logs=None):
+        self.stop(finished=True)
+
+def profile_window(cfg):
+    """
+    Callbacks for the config's optional profile block, e.g.
+    profile: {start_step: 10, num_steps: 5, log_dir: profiles}. The trace
+    goes to a folder named after the experiment inside log_dir.
+
+    Parameters:
+    - cfg (dict): The experiment config
+
+    Returns:
+    list: [ProfileWindow], or [] if the config has no profile block
+    """
+    profile = cfg.get('profile')
+    if not profile:
+        return []
+    return [ProfileWindow(os.path.join(profile.get('log_dir', 'profiles'), cfg['experiment_name']),
+                          start_step=profile.get('start_step', 10),
+                          num_steps=profile.get('num_steps', 5),
+                          host_tracer_level=profile.get('host_tracer_level', 2))]
+
+def stream_predictions(model, data, callbacks=[]):
+    """
+    Runs the model once over an evaluation dataset and yields, per batch, the
+    true labels, the softmax probabilities and the rows they belong to.
+    Labels come from the same stream as the images, so a split is decoded
+    and run through the model only once.
+
+    Parameters:
+    - model (Model): The model to evaluate
+    - data (Dataset): Batches of (inputs, labels), sparse or one-hot, in row order
+    - callbacks (list): Prediction callbacks, e.g. profile_window(cfg)
+
+    Yields:
+    tuple: (labels, probs, rows) of one batch, rows being a slice
+    """
+    start = 0
+    for batch, (inputs, labels) in enumerate(data):
+        for callback in callbacks:
+            callback.on_predict_batch_begin(batch)
+        probs = model.predict_on_batch(inputs)
+        for callback in callbacks:
+            callback.on_predict_batch_end(batch)
+
+        labels = labels.numpy()
+        if labels.ndim > 1:
+            labels = labels.argmax(axis=1)
+        rows = slice(start, start + len(labels))
+        start = rows.stop
+        yield labels, probs, rows
+
+    for callback in callbacks:
+        callback.on_predict_end()
+
+
+def collect_predictions(model, loader, events=None, callbacks=[]):
+    """
+    Evaluates a model on a loader's split in one pass, filling preallocated
+    arrays batch by batch.
+
+    Parameters:
+    - model (Model): The model to evaluate
+    - loader (CTDataset): Loader of a non-training split, which keeps annotation order
+    - events (array): Sampling event of every row, or None
+    - callbacks (list): Prediction callbacks, e.g. profile_window(cfg)
+
+    Returns:
+    tuple: (labels, probs, events) of every row, events None if not given
+    """
+    n = len(loader.img_file_names)
+    all_true = np.empty(n, dtype=np.int64)
+    probs = np.empty((n, loader.num_class), dtype=np.float32)
+    if events is not None:
+        events = np.asarray(events)
+        event_ids = np.empty(n, dtype=events.dtype)
+    else:
+        event_ids = None
+
+    seen = 0
+    for labels, batch_probs, rows in stream_predictions(model, loader.create_tf_dataset(), callbacks):
+        all_true[rows] = labels
+        probs[rows] = batch_probs
+        if events is not None:
+            event_ids[rows] = events[rows]
+        seen = rows.stop
+    if seen != n:
+        raise ValueError(f'Expected {n} rows from the {loader.split} split, got {seen}')
+    return all_true, probs, event_ids
+
+
+def event_hook(events, batch_size):
+    """
+    A loader batch_hook that adds the sampling event ids of every row, as
+    strings, in front of the inputs, for models.build_masked_model. Being a
+    batch_hook, it runs before the loader's prefetch (see CTDataset.prefetch).
+
+    Parameters:
+    - events (array): Sampling event of every row, in row order
+    - batch_size (int): Batch size of the loader
+
+    Returns:
+    callable: Maps batches of (inputs, labels) to ((events, *inputs), labels)
+    """
+    events = np.asarray(events).astype(str)
+
+    def prepend(event, batch):
+        inputs, labels = batch
+        inputs = inputs if isinstance(inputs, tuple) else (inputs,)
+        return (event, *inputs), labels
+
+    def hook(data):
+        batches = tf.data.Dataset.from_tensor_slices(events).batch(batch_size)
+        return tf.data.Dataset.zip((batches, data)).map(prepend)
+
+    return hook
+
+
+def predict_split(cfg, checkpoint, loader, events=None, callbacks=[], recompute=False):
+    """
+    Labels, probabilities and events of a loader's split from the prediction
+    store (see prediction_store.py), or from one collect_predictions() pass
+    of the checkpoint, which is then added to the store. The store key uses
+    the annotation files the loader read: loader.anno_path, and
+    loader.train_path for the label encoding.
+
+    Parameters:
+    - cfg (dict): The experiment config
+    - checkpoint (str): Path of the checkpoint, as models.load_checkpoint takes
+    - loader (CTDataset): Loader of a non-training split
+    - events (array): Sampling event of every row, or None
+    - callbacks (list): Prediction callbacks, e.g. profile_window(cfg)
+    - recompute (bool): Rerun the model even if the store has the predictions
+
+    Returns:
+    tuple: (labels, probs, events) of every row, events None if not given
+    """
+    key = prediction_key(checkpoint, loader.anno_path, loader.train_path,
+                         image_set_hash(cfg, loader.img_file_names, loader.interpolation))
+    stored = None if recompute else load_predictions(cfg, key)
+    if stored is not None:
+        print(f'Predictions of {checkpoint} read from the store ({key})')
+        labels, probs, event_ids = stored
+        if event_ids is None and events is not None:
+            event_ids = np.asarray(events)
+        return labels, probs, event_ids
+
+    model = load_checkpoint(checkpoint)
+    labels, probs, event_ids = collect_predictions(model, loader, events, callbacks)
+    save_predictions(cfg, key, labels, probs, event_ids,
+                     meta={'checkpoint': checkpoint, 'annotations': loader.anno_path, 'split': loader.split})
+    return labels, probs, event_ids
+
 
 def hierarchy(Y_ordered):
     hierarchy_long = {"Phylum": Y_ordered.copy(),